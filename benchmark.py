@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+"""Time panexcel on large synthetic Panorama configs.
+
+Generates a config with the same layout as configs-example/panorama-example.xml (shared
+and device group objects, nested address groups, pre and post rulebases and the device
+group hierarchy), or with -v as configs-example/policy-best-practices.xml (virtual systems
+with their objects and rulebase), and measures the time and peak memory of each phase of an export. Every
+phase runs in its own process, after the phases it needs, so the peak memory of one phase
+is not hidden by the peak of an earlier one. Results are printed as JSON and can be
+appended to a JSON Lines file to follow them across versions."""
+
+from lxml import etree
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import panexcel
+
+zones = ["trust", "untrust", "dmz", "internal", "external", "guest", "vpn", "mgmt", "lab", "partners"]
+applications = ["any", "web-browsing", "ssl", "dns", "ssh", "ntp", "smtp", "ldap", "ms-rdp", "snmp"]
+services = ["application-default", "any", "service-http", "service-https"]
+phases = ["parse", "index", "extract", "objectreport", "xlsx"]
+
+
+def commandlineparser():
+    """Select the proper arguments needed"""
+    global args
+    parser = argparse.ArgumentParser(description='Benchmark panexcel on a synthetic Panorama config')
+    parser.add_argument('-c', '--configfile', required=False, help='Benchmark an existing config file instead of generating one')
+    parser.add_argument('-v', '--virtualsystem', action="store_true", required=False, default=False, help='Generate, or benchmark with -c, a firewall config with Virtual Systems instead of Device Groups')
+    parser.add_argument('--devicegroups', type=int, default=10, required=False, help='Number of device groups, or of virtual systems with -v')
+    parser.add_argument('--rules', type=int, default=20000, required=False, help='Number of security rules, spread over the device groups')
+    parser.add_argument('--addresses', type=int, default=5000, required=False, help='Number of address objects, 10%% of them shared')
+    parser.add_argument('--groups', type=int, default=500, required=False, help='Number of address groups')
+    parser.add_argument('--depth', type=int, default=3, required=False, help='Levels of address groups nested in each other')
+    parser.add_argument('--members', type=int, default=4, required=False, help='Maximum number of sources and destinations per rule')
+    parser.add_argument('--objects', type=int, default=10, required=False, help='Number of objects looked up in the object report phase')
+    parser.add_argument('--seed', type=int, default=1, required=False, help='Seed of the generator, the same seed gives the same config')
+    parser.add_argument('--keep', required=False, help='Keep the generated config with this filename')
+    parser.add_argument('--results', required=False, help='Append the results as one JSON line to this file')
+    args = parser.parse_args()
+
+
+def getAddress(i):
+    """Return the ip-netmask of address number i: hosts, /24 and /16 networks."""
+    if i % 10 == 0:
+        return "10.%d.0.0/16" % (i // 10 % 256)
+    if i % 3 == 0:
+        return "10.%d.%d.0/24" % (i // 256 % 256, i % 256)
+    return "10.%d.%d.%d" % (i // 65536 % 256, i // 256 % 256, i % 256)
+
+def writeObjects(output, prefix, addresses, groups, depth, indent):
+    """Write the address and address-group elements of a scope and return the names of its
+    objects and groups. Groups of level 0 contain addresses, groups of the next levels contain
+    groups of the level below and one address."""
+    names = ["%s-host-%d" % (prefix, i) for i in range(addresses)]
+    output.write(indent + "<address>\n")
+    for i, name in enumerate(names):
+        output.write(indent + '  <entry name="%s">\n%s    <ip-netmask>%s</ip-netmask>\n%s  </entry>\n' % (name, indent, getAddress(random.randint(0, 999999)), indent))
+    output.write(indent + "</address>\n")
+
+    groupnames = []
+    output.write(indent + "<address-group>\n")
+    levels = [[] for level in range(max(depth, 1))]
+    for i in range(groups):
+        level = i % len(levels)
+        name = "%s-group-%d-%d" % (prefix, level, i)
+        if level == 0 or not levels[level - 1]:
+            members = random.sample(names, min(3, len(names)))
+        else:
+            members = random.sample(levels[level - 1], min(2, len(levels[level - 1]))) + random.sample(names, min(1, len(names)))
+        levels[level].append(name)
+        groupnames.append(name)
+        output.write(indent + '  <entry name="%s">\n%s    <static>\n' % (name, indent))
+        for member in members:
+            output.write(indent + "      <member>%s</member>\n" % member)
+        output.write(indent + "    </static>\n%s  </entry>\n" % indent)
+    output.write(indent + "</address-group>\n")
+    return names + groupnames
+
+def writeMembers(output, field, members, indent):
+    """Write a rule field with its members."""
+    output.write(indent + "<%s>\n" % field)
+    for member in members:
+        output.write(indent + "  <member>%s</member>\n" % member)
+    output.write(indent + "</%s>\n" % field)
+
+def writeRules(output, prefix, rules, objects, members, indent):
+    """Write the rules element of one rulebase."""
+    output.write(indent + "<security>\n%s  <rules>\n" % indent)
+    entry = indent + "    "
+    for i in range(rules):
+        output.write(entry + '<entry name="%s-rule-%d">\n' % (prefix, i))
+        field = entry + "  "
+        writeMembers(output, "from", random.sample(zones, random.randint(1, 2)), field)
+        writeMembers(output, "to", random.sample(zones, random.randint(1, 2)), field)
+        for address in ("source", "destination"):
+            if random.random() < 0.1 or not objects:
+                writeMembers(output, address, ["any"], field)
+            else:
+                writeMembers(output, address, random.sample(objects, min(random.randint(1, members), len(objects))), field)
+        writeMembers(output, "source-user", ["any"], field)
+        writeMembers(output, "category", ["any"], field)
+        writeMembers(output, "application", random.sample(applications, random.randint(1, 3)), field)
+        writeMembers(output, "service", [random.choice(services)], field)
+        writeMembers(output, "hip-profiles", ["any"], field)
+        output.write(field + "<action>%s</action>\n" % random.choice(["allow", "allow", "deny"]))
+        if i % 5 == 0:
+            output.write(field + "<description>Generated rule %d</description>\n" % i)
+        output.write(entry + "</entry>\n")
+    output.write(indent + "  </rules>\n%s</security>\n" % indent)
+
+def generateConfig(filename, devicegroups, rules, addresses, groups, depth, members, seed, vsys=False):
+    """Write a synthetic Panorama config. Device group i has DG-(i - 1) / 2 as parent, and 80%
+    of its rules are in the pre-rulebase and the rest in the post-rulebase. With vsys, write a
+    firewall config with devicegroups virtual systems, each with its objects and one rulebase."""
+    random.seed(seed)
+    output = open(filename, "w")
+    output.write('<?xml version="1.0"?>\n<config version="8.0.0">\n  <shared>\n')
+    shared = writeObjects(output, "shared", addresses // 10, groups // 10, depth, "    ")
+    if vsys:
+        output.write("  </shared>\n  <devices>\n    <entry name=\"localhost.localdomain\">\n      <vsys>\n")
+        for vs in range(devicegroups):
+            name = "vsys%d" % (vs + 1)
+            output.write('        <entry name="%s">\n' % name)
+            objects = shared + writeObjects(output, name, (addresses - addresses // 10) // devicegroups, (groups - groups // 10) // devicegroups, depth, "          ")
+            output.write("          <rulebase>\n")
+            writeRules(output, name, rules // devicegroups + (1 if vs < rules % devicegroups else 0), objects, members, "            ")
+            output.write("          </rulebase>\n        </entry>\n")
+        output.write("      </vsys>\n    </entry>\n  </devices>\n</config>\n")
+        output.close()
+        return
+    output.write("  </shared>\n  <devices>\n    <entry name=\"localhost.localdomain\">\n      <device-group>\n")
+    for dg in range(devicegroups):
+        name = "DG-%d" % dg
+        output.write('        <entry name="%s">\n          <devices/>\n' % name)
+        objects = shared + writeObjects(output, name, (addresses - addresses // 10) // devicegroups, (groups - groups // 10) // devicegroups, depth, "          ")
+        dgrules = rules // devicegroups + (1 if dg < rules % devicegroups else 0)
+        output.write("          <pre-rulebase>\n")
+        writeRules(output, name + "-pre", dgrules - dgrules // 5, objects, members, "            ")
+        output.write("          </pre-rulebase>\n          <post-rulebase>\n")
+        writeRules(output, name + "-post", dgrules // 5, objects, members, "            ")
+        output.write("          </post-rulebase>\n        </entry>\n")
+    output.write("      </device-group>\n    </entry>\n  </devices>\n  <readonly>\n    <dg-meta-data>\n      <dg-info>\n")
+    for dg in range(1, devicegroups):
+        output.write('        <entry name="DG-%d">\n          <parent-dg>DG-%d</parent-dg>\n        </entry>\n' % (dg, (dg - 1) // 2))
+    output.write("      </dg-info>\n    </dg-meta-data>\n  </readonly>\n</config>\n")
+    output.close()
+
+
+def runPhase(phase, configfile, virtual_or_deviceg, objects, outputdir, queue):
+    """Run the phases before phase untimed, then phase, and put its measures in the queue."""
+    steps = [step for step in phases[:phases.index(phase) + 1] if step != "objectreport" or step == phase] # xlsx does not need it.
+    measures = {}
+    for step in steps:
+        if step == phase:
+            measures["baseline_mb"] = panexcel.getPeakMemory()
+            started = time.time()
+        if step == "parse":
+            document = etree.parse(configfile).getroot()
+        elif step == "index":
+            objectindex = panexcel.ObjectIndex(document)
+            resolver = panexcel.GroupResolver(objectindex, panexcel.getHierarchy(document))
+            usageindex = panexcel.UsageIndex(document, objectindex)
+        elif step == "extract":
+            records = list(panexcel.getRules(document, virtual_or_deviceg, resolver=resolver))
+            measures["rules"] = len(records)
+        elif step == "objectreport":
+            names = [entry.attrib.get("name") for entry in objectindex.getEntries("address")]
+            names = names[::max(len(names) // objects, 1)][:objects]
+            sink = panexcel.MemorySink()
+            panexcel.writeRowHeaders(sink, True)
+            panexcel.writeObjectHeaders(sink, False) # Only the address objects of the rules found.
+            wanted = set(usageindex.findRules(names)).__contains__
+            panexcel.writeExport(sink, panexcel.getRules(document, virtual_or_deviceg, wanted=wanted, resolver=resolver), objectindex, resolver, False, True)
+            measures["rules"] = len(sink.sheets["Rules"])
+        elif step == "xlsx":
+            sink = panexcel.getSink("xlsx", os.path.join(outputdir, "benchmark.xlsx"))
+            panexcel.writeRowHeaders(sink, True)
+            panexcel.writeObjectHeaders(sink, True)
+            panexcel.writeExport(sink, records, objectindex, resolver, True, True)
+            sink.close()
+    measures["seconds"] = round(time.time() - started, 3)
+    measures["peak_mb"] = panexcel.getPeakMemory()
+    queue.put(measures)
+
+def getCommit():
+    """Return the git commit of panexcel, or None outside a git checkout."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(panexcel.__file__)),
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+
+    commandlineparser()
+
+    outputdir = tempfile.mkdtemp(prefix="panexcel-benchmark-")
+    results = OrderedDict([("commit", getCommit()), ("python", sys.version.split()[0]), ("date", time.strftime("%Y-%m-%dT%H:%M:%S"))])
+    if args.configfile != None:
+        configfile = args.configfile
+        results["config"] = configfile
+    else:
+        configfile = args.keep or os.path.join(outputdir, "benchmark.xml")
+        started = time.time()
+        generateConfig(configfile, args.devicegroups, args.rules, args.addresses, args.groups, args.depth, args.members, args.seed, args.virtualsystem)
+        results["generated"] = OrderedDict([("devicegroups", args.devicegroups), ("vsys", args.virtualsystem), ("rules", args.rules), ("addresses", args.addresses), ("groups", args.groups),
+                                            ("depth", args.depth), ("members", args.members), ("seed", args.seed), ("seconds", round(time.time() - started, 3))])
+    results["config_mb"] = round(os.path.getsize(configfile) / 1048576.0, 1)
+
+    if args.virtualsystem:
+        virtual_or_deviceg = 'vsys'
+    else:
+        virtual_or_deviceg = 'device-group'
+
+    results["phases"] = OrderedDict()
+    for phase in phases:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=runPhase, args=(phase, configfile, virtual_or_deviceg, args.objects, outputdir, queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            sys.exit("The %s phase failed. Stopping execution" % phase)
+        results["phases"][phase] = queue.get()
+        print >> sys.stderr, phase, results["phases"][phase]
+
+    shutil.rmtree(outputdir) # The generated config too, unless it was kept somewhere else.
+    print json.dumps(results, indent=2)
+    if args.results != None:
+        with open(args.results, "a") as resultsfile:
+            resultsfile.write(json.dumps(results) + "\n")
@@ -2,244 +2,1191 @@
 
 from lxml import etree # Difficult to use but good XML parser.
 import xlsxwriter # Creates an Excel Spreadsheet.
+import BaseHTTPServer
 import argparse
-
-class Spreadsheet(object):
-    """Create a spreadsheet from the XML document."""
-    def __init__(self):
-        """Initial values to avoid issues when empty values"""
-        self.name = None
-        self.from_member = ""
-        self.to_member = ""
-        self.source = ""
-        self.source_trans = ""
-        self.destination = ""
-        self.destination_trans = ""
-        self.application = ""
-        self.service = ""
-        self.hipprofiles = ""
-        self.action = None
-        self.description = None
-        self.logstart = None
-        self.logend = None
-        self.tag = ""
-        self.profilesetting = ""
-        self.disabled = "no" # Set to no since the PAN might return nothing for permit.
-        self.expiration = None
-        self.rulesection = ""
-        self.ruletype = ""
-        self.firewall= ""
-
-        self.groupname= ""
-        self.objectname = ""
-        self.objectvalue = ""
-        self.objectdescription = ""
-        self.objectFQDN = "no"
-        self.objectshared = "no"
-
-    def writeRowHeaders(self):
-        """Write the header row of the rule sheet."""
-        titles = ["Rule Name", "From Zone", "To Zone", "Source", "Source Translation", "Destination", "Destination Translation", "Application", "Services", "Hip-Profile", "Action", "Description", "Log-start", "Log-end", "Tags", "Profile-settings", "Disabled", "Expiration", "Rule Section", "Rule Type", "Firewall"]
-        i = 0
-        for title in titles:
-            worksheet.write(0, i, title, bold)
-            i += 1
-
-    def writeObjectHeaders(self):
-        """Write the header row of the object sheet"""
-        titles = ["Object Name", "Object Value", "Description", "FQDN", "Shared"]
-        i = 0
-        for title in titles:
-            worksheet_objects.write(0, i, title, bold)
-            i += 1
-
-    def setName(self, name):
-        """Populate the firewall rule description."""
-        self.name = name
-
-    def setFromMember(self, from_member):
-        """Set firewall from zone."""
-        if not self.from_member == "": # If there are multiple entries add a comma to separate.
-            self.from_member += chr(10)
-        self.from_member +=str(from_member) # Concatenate each entry.
-
-    def setToMember(self, to_member):
-        """Set firewall to zone."""
-        if not self.to_member == "": # If there are multiple entries add a comma to separate.
-            self.to_member += chr(10)
-        self.to_member +=str(to_member) # Concatenate each entry.
-
-    def setSource(self, source):
-        """Set firewall from source."""
-        if not self.source == "": # If there are multiple entries add a comma to separate.
-            self.source += chr(10)
-        self.source +=str(source) # Concatenate each entry.
-
-    def setSourceTranslation(self, source_trans):
-        """Set firewall from source Translation in NAT rules"""
-        if not self.source_trans == "": # If there are multiple entries add a comma to separate.
-            self.source_trans += chr(10)
-        self.source_trans +=str(source_trans) # Concatenate each entry.
-
-    def setDestination(self, destination):
-        """Set firewall to destination."""
-        if not self.destination == "": # If there are multiple entries add a comma to separate.
-            self.destination += chr(10)
-        self.destination +=str(destination) # Concatenate each entry.
-
-    def setDestinationTranslation(self, destination_trans):
-        """Set firewall from destination Translation for NAT rules."""
-        if not self.destination_trans == "": # If there are multiple entries add a comma to separate.
-            self.destination_trans += chr(10)
-        self.destination_trans +=str(destination_trans) # Concatenate each entry.
-
-    def setApplication(self, application):
-        """Set firewall to application."""
-        if not self.application == "": # If there are multiple entries add a comma to separate.
-            self.application += chr(10)
-        self.application +=str(application) # Concatenate each entry.
-
-    def setServices(self, service):
-        """Set firewall to Services."""
-        if not self.service == "": # If there are multiple entries add a comma to separate.
-            self.service += chr(10)
-        self.service +=str(service) # Concatenate each entry.
-
-    def setHipprofiles(self, hipprofiles):
-        """Set HIP-Profile applied"""
-        if not self.hipprofiles == "": # If there are multiple entries add a comma to separate.
-            self.hipprofiles += chr(10)
-        self.hipprofiles +=str(hipprofiles) # Concatenate each entry.
-
-    def setAction(self, action):
-        """Populate the firewall rule action."""
-        self.action = action
-
-    def setDescription(self, description):
-        """Populate the firewall description."""
-        self.description = description
-
-    def setLogstart(self, logstart):
-        """Set if rule has logstart."""
-        self.logstart = logstart
-
-    def setLogend(self, logend):
-        """Set if rule has Logend."""
-        self.logend = logend
-
-    def setTag(self, tag):
-        """Set firewall TAGS"""
-        if not self.tag == "": # If there are multiple entries add a comma to separate.
-            self.tag += chr(10)
-        self.tag +=str(tag) # Concatenate each entry.
-
-    def setProfilesetting(self, profilesetting):
-        """Set Profile settings."""
-        if not self.profilesetting == "": # If there are multiple entries add a comma to separate.
-            self.profilesetting += chr(10)
-        self.profilesetting +=str(profilesetting) # Concatenate each entry.
-
-    def setDisabled(self, disabled):
-        """Set if rule is disabled."""
-        self.disabled = disabled
-
-    def setExpiration(self, expiration):
-        """Set if rule has expiration object."""
-        self.expiration = expiration
-
-    def setRulesection(self, rulesection):
-        """Set rulesection."""
-        self.rulesection = rulesection
-
-    def setRuletype(self, ruletype):
-        """Set ruletype."""
-        self.ruletype = ruletype
-
-    def setFirewall(self, firewall):
-        """Set Firewall or VSYS."""
-        self.firewall = firewall
-
-    def setGroupname(self, groupname):
-        """Set Groupname."""
-        self.groupname = groupname
-
-    def setObjectname(self, objectname):
-        """Populate object name."""
-        self.objectname = objectname
-
-    def setObjectvalue(self, objectvalue):
-        """Populate object value."""
-        self.objectvalue = objectvalue
-
-    def setObjectdescription(self, objectdescription):
-        """Populate object description."""
-        self.objectdescription = objectdescription
-
-    def setObjectFQDN(self, objectFQDN):
-        """Populate if object is FQDN."""
-        self.objectFQDN = objectFQDN
-
-    def setObjectShared(self, objectshared):
-        """Populate if object is Shared."""
-        self.objectshared = objectshared
-
-    def writeRow(self, row):
-        """Writes row to Excel workbook"""
-        # Insert validation later
-        worksheet.write(row, 0, self.name, dataformat)
-        worksheet.write(row, 1, self.from_member, dataformat)
-        worksheet.write(row, 2, self.to_member, dataformat)
-        worksheet.write(row, 3, self.source, dataformat)
-        worksheet.write(row, 4, self.source_trans, dataformat)
-        worksheet.write(row, 5, self.destination, dataformat)
-        worksheet.write(row, 6, self.destination_trans, dataformat)
-        worksheet.write(row, 7, self.application, dataformat)
-        worksheet.write(row, 8, self.service, dataformat)
-        worksheet.write(row, 9, self.hipprofiles, dataformat)
-        worksheet.write(row, 10, self.action, dataformat)
-        worksheet.write(row, 11, self.description, dataformat)
-        worksheet.write(row, 12, self.logstart, dataformat)
-        worksheet.write(row, 13, self.logend, dataformat)
-        worksheet.write(row, 14, self.tag, dataformat)
-        worksheet.write(row, 15, self.profilesetting, dataformat)
-        worksheet.write(row, 16, self.disabled, dataformat)
-        worksheet.write(row, 17, self.expiration, dataformat)
-        worksheet.write(row, 18, self.rulesection, dataformat)
-        worksheet.write(row, 19, self.ruletype, dataformat)
-        worksheet.write(row, 20, self.firewall, dataformat)
-
-        print "Name: ", self.name
-        print "From Zone: ", self.from_member
-        print "To Zone: ", self.to_member
-        print "Source: ", self.source
-        print "Destination: ", self.destination
-        print "Application: ", self.application
-        print "Service", self.service
-        print "Action: ", self.action
-        print "Disabled: ", self.disabled
-        print "Description: ", self.description
-        print "Expiration: ", self.expiration
+import bisect
+import cPickle
+import cProfile
+import copy
+import csv
+import glob
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import resource
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import urlparse
+from collections import OrderedDict, namedtuple
+
+verbose = False # Print every rule and object found, set with --verbose.
+
+class RuleRecord(namedtuple("RuleRecord", ["name", "from_member", "to_member", "source", "source_trans", "destination", "destination_trans",
+                                             "application", "service", "hipprofiles", "action", "description", "logstart", "logend",
+                                             "tag", "profilesetting", "disabled", "expiration", "rulesection", "ruletype", "firewall",
+                                             "resolved_source", "resolved_destination"])):
+    """One row of the Rules sheet. Immutable, fields in column order.
+
+    Multi-valued fields (zones, addresses, applications...) are tuples of members,
+    joined only by the output formats that need a single string."""
+    __slots__ = ()
+    titles = ["Rule Name", "From Zone", "To Zone", "Source", "Source Translation", "Destination", "Destination Translation", "Application", "Services", "Hip-Profile", "Action", "Description", "Log-start", "Log-end", "Tags", "Profile-settings", "Disabled", "Expiration", "Rule Section", "Rule Type", "Firewall", "Resolved Source", "Resolved Destination"]
+    lists = ["From Zone", "To Zone", "Source", "Source Translation", "Destination", "Destination Translation", "Application", "Services", "Hip-Profile", "Tags", "Profile-settings", "Resolved Source", "Resolved Destination"]
+    resolvedcolumns = 2 # Resolved Source and Resolved Destination are only written with -g.
+
+
+class ObjectRecord(namedtuple("ObjectRecord", ["objectname", "objectvalue", "objectdescription", "objectFQDN", "objectshared", "objectscope"])):
+    """One row of the Objects sheet (address objects). Immutable, fields in column order."""
+    __slots__ = ()
+    sheet = "Objects"
+    titles = ["Object Name", "Object Value", "Description", "FQDN", "Shared", "Scope"]
+    lists = []
+
+
+class AddressGroupRecord(namedtuple("AddressGroupRecord", ["groupname", "grouptype", "members", "filter", "description", "tag", "scope"])):
+    """One row of the Address Groups sheet. grouptype is static or dynamic, filter is only set for dynamic groups."""
+    __slots__ = ()
+    sheet = "Address Groups"
+    titles = ["Group Name", "Type", "Members", "Filter", "Description", "Tags", "Scope"]
+    lists = ["Members", "Tags"]
+
+
+class ServiceRecord(namedtuple("ServiceRecord", ["servicename", "protocol", "port", "sourceport", "description", "tag", "scope"])):
+    """One row of the Services sheet."""
+    __slots__ = ()
+    sheet = "Services"
+    titles = ["Service Name", "Protocol", "Port", "Source Port", "Description", "Tags", "Scope"]
+    lists = ["Tags"]
+
+
+class ServiceGroupRecord(namedtuple("ServiceGroupRecord", ["groupname", "members", "tag", "scope"])):
+    """One row of the Service Groups sheet."""
+    __slots__ = ()
+    sheet = "Service Groups"
+    titles = ["Group Name", "Members", "Tags", "Scope"]
+    lists = ["Members", "Tags"]
+
+
+class ApplicationGroupRecord(namedtuple("ApplicationGroupRecord", ["groupname", "members", "scope"])):
+    """One row of the Application Groups sheet."""
+    __slots__ = ()
+    sheet = "Application Groups"
+    titles = ["Group Name", "Members", "Scope"]
+    lists = ["Members"]
+
+
+class TagRecord(namedtuple("TagRecord", ["tagname", "color", "comments", "scope"])):
+    """One row of the Tags sheet."""
+    __slots__ = ()
+    sheet = "Tags"
+    titles = ["Tag Name", "Color", "Comments", "Scope"]
+    lists = []
+
+
+class ScheduleRecord(namedtuple("ScheduleRecord", ["schedulename", "scheduletype", "times", "scope"])):
+    """One row of the Schedules sheet. times are the ranges of the schedule, prefixed by the
+    day for weekly schedules."""
+    __slots__ = ()
+    sheet = "Schedules"
+    titles = ["Schedule Name", "Type", "Times", "Scope"]
+    lists = ["Times"]
+
+
+def writeRowHeaders(sink, resolvegroups=False, sheet="Rules", columns=None):
+    """Write the header row of the rule sheet, with only the fields of columns if given."""
+    if columns is not None:
+        sink.addSheet(sheet, [RuleRecord.titles[i] for i in columns], RuleRecord.lists)
+    elif resolvegroups:
+        sink.addSheet(sheet, RuleRecord.titles, RuleRecord.lists)
+    else:
+        sink.addSheet(sheet, RuleRecord.titles[:-RuleRecord.resolvedcolumns], RuleRecord.lists)
+
+def writeObjectHeaders(sink, typed=False):
+    """Write the header row of the object sheet, and of the sheets of the other object types with typed"""
+    sink.addSheet("Objects", ObjectRecord.titles)
+    if typed:
+        for recordtype, getrecord in typedobjects.values():
+            sink.addSheet(recordtype.sheet, recordtype.titles, recordtype.lists)
+
+def writeRow(sink, record, resolvegroups=False, sheet="Rules", columns=None):
+    """Writes a rule to the output"""
+    if columns is not None:
+        sink.writeRow(sheet, [record[i] for i in columns])
+    elif resolvegroups:
+        sink.writeRow(sheet, record)
+    else:
+        sink.writeRow(sheet, record[:-RuleRecord.resolvedcolumns])
+
+    if verbose:
+        print "Name: ", record.name
+        print "From Zone: ", chr(10).join(record.from_member or ()) # None for the fields not in --columns.
+        print "To Zone: ", chr(10).join(record.to_member or ())
+        print "Source: ", chr(10).join(record.source or ())
+        print "Destination: ", chr(10).join(record.destination or ())
+        print "Application: ", chr(10).join(record.application or ())
+        print "Service", chr(10).join(record.service or ())
+        print "Action: ", record.action
+        print "Disabled: ", record.disabled
+        print "Description: ", record.description
+        print "Expiration: ", record.expiration
         print "\n"
 
-    def writeObjectRow(self, row):
-        """Writes row to Excel workbook"""
-        # Insert validation later
-        worksheet_objects.write(row, 0, self.objectname, dataformat)
-        worksheet_objects.write(row, 1, self.objectvalue, dataformat)
-        worksheet_objects.write(row, 2, self.objectdescription, dataformat)
-        worksheet_objects.write(row, 3, self.objectFQDN, dataformat)
-        worksheet_objects.write(row, 4, self.objectshared, dataformat)
+def writeObjectRow(sink, record):
+    """Writes an object to the sheet of its type"""
+    sink.writeRow(record.sheet, record)
+
+
 
+class Sink(object):
+    """Base class of the output formats.
 
-    def newRow(self):
-        """Prepares for new row by clearing variables in class"""
-        excelobj.__init__()
+    Rows are written sheet by sheet with writeRow after addSheet has declared the titles
+    of the sheet. Columns listed in lists hold lists of members instead of single values, and
+    columns listed in integers hold numbers instead of strings."""
+    extension = ""
 
-    def newObjectRow(self):
-        """Prepares for new row by clearing variables in class"""
-        excelobjects.__init__()
+    def __init__(self, filename):
+        """filename is the output file, or the prefix of one file per sheet."""
+        self.filename = filename
+        self.titles = {}
+        self.lists = {}
+        self.integers = {}
 
+    def addSheet(self, sheet, titles, lists=(), integers=()):
+        """Declare a sheet and its column titles."""
+        self.titles[sheet] = titles
+        self.lists[sheet] = [title in lists for title in titles]
+        self.integers[sheet] = [title in integers for title in titles]
+
+    def getSheetFilename(self, sheet):
+        """Return the file of one sheet for formats that write a file per sheet."""
+        return os.path.splitext(self.filename)[0] + "_" + sheet.replace(" ", "_") + self.extension
+
+    def writeRow(self, sheet, values):
+        """Write one row to a sheet."""
+        raise NotImplementedError
+
+    def close(self):
+        """Flush and close every file."""
+        raise NotImplementedError
+
+
+class XlsxSink(Sink):
+    """Write every sheet to one Excel workbook. Lists are joined with a line break."""
+    extension = ".xlsx"
+
+    def __init__(self, filename):
+        Sink.__init__(self, filename)
+        # constant_memory flushes every row to disk once the next one starts, so the writer memory
+        # does not grow with the number of rules. Rows are always written in increasing order.
+        self.workbook = xlsxwriter.Workbook(filename, {'constant_memory': True}) # Create Excel spreadsheet.
+        self.bold = self.workbook.add_format({'bold': True}) # Cell formatting for row header
+        self.dataformat = self.workbook.add_format() # Cell Formatting for data.
+        self.dataformat.set_align('top')
+        self.worksheets = {}
+        self.rows = {}
+
+    def addSheet(self, sheet, titles, lists=(), integers=()):
+        Sink.addSheet(self, sheet, titles, lists, integers)
+        self.worksheets[sheet] = self.workbook.add_worksheet(sheet) # Create new worksheet within the spreadsheet.
+        self.worksheets[sheet].write_row(0, 0, titles, self.bold)
+        self.rows[sheet] = 0
+
+    def writeRow(self, sheet, values):
+        self.rows[sheet] += 1
+        values = [chr(10).join(value) if islist else value for value, islist in zip(values, self.lists[sheet])]
+        self.worksheets[sheet].write_row(self.rows[sheet], 0, values, self.dataformat)
+
+    def close(self):
+        self.workbook.close() # Close the spreadsheet since we are done with it now.
+
+
+class CsvSink(Sink):
+    """Write one CSV file per sheet, row by row. Lists are joined with ";"."""
+    extension = ".csv"
+
+    def __init__(self, filename):
+        Sink.__init__(self, filename)
+        self.files = {}
+        self.writers = {}
+
+    def addSheet(self, sheet, titles, lists=(), integers=()):
+        Sink.addSheet(self, sheet, titles, lists, integers)
+        self.files[sheet] = open(self.getSheetFilename(sheet), "wb")
+        self.writers[sheet] = csv.writer(self.files[sheet])
+        self.writers[sheet].writerow(titles)
 
+    def writeRow(self, sheet, values):
+        values = [";".join(value) if islist else value for value, islist in zip(values, self.lists[sheet])]
+        self.writers[sheet].writerow([value.encode("utf-8") if isinstance(value, unicode) else value for value in values])
+
+    def close(self):
+        for csvfile in self.files.values():
+            csvfile.close()
+
+
+class JsonLinesSink(Sink):
+    """Write one JSON Lines file per sheet, one object per row. Lists are JSON arrays."""
+    extension = ".jsonl"
+
+    def __init__(self, filename):
+        Sink.__init__(self, filename)
+        self.files = {}
+
+    def addSheet(self, sheet, titles, lists=(), integers=()):
+        Sink.addSheet(self, sheet, titles, lists, integers)
+        self.files[sheet] = open(self.getSheetFilename(sheet), "wb")
+
+    def writeRow(self, sheet, values):
+        self.files[sheet].write(json.dumps(OrderedDict(zip(self.titles[sheet], values))) + "\n")
+
+    def close(self):
+        for jsonfile in self.files.values():
+            jsonfile.close()
+
+
+class ParquetSink(Sink):
+    """Write one Parquet file per sheet. Rows are buffered and written as columnar record
+    batches. Lists are list<string> columns."""
+    extension = ".parquet"
+    batchsize = 10000
+
+    def __init__(self, filename):
+        global pyarrow
+        try:
+            import pyarrow # Only needed for --format parquet, loading it costs startup time and memory.
+            import pyarrow.parquet
+        except ImportError:
+            sys.exit("pyarrow is needed to write parquet files. Stopping execution")
+        Sink.__init__(self, filename)
+        self.writers = {}
+        self.schemas = {}
+        self.batches = {}
+
+    def addSheet(self, sheet, titles, lists=(), integers=()):
+        Sink.addSheet(self, sheet, titles, lists, integers)
+        self.schemas[sheet] = pyarrow.schema([pyarrow.field(title, pyarrow.list_(pyarrow.string()) if islist else pyarrow.int64() if isinteger else pyarrow.string())
+                                              for title, islist, isinteger in zip(titles, self.lists[sheet], self.integers[sheet])])
+        self.writers[sheet] = pyarrow.parquet.ParquetWriter(self.getSheetFilename(sheet), self.schemas[sheet])
+        self.batches[sheet] = []
+
+    def writeRow(self, sheet, values):
+        self.batches[sheet].append(values)
+        if len(self.batches[sheet]) >= self.batchsize:
+            self.writeBatch(sheet)
+
+    def writeBatch(self, sheet):
+        """Write the buffered rows of a sheet as one record batch."""
+        rows = self.batches[sheet]
+        columns = [pyarrow.array([row[i] for row in rows], type=field.type) for i, field in enumerate(self.schemas[sheet])]
+        self.writers[sheet].write_table(pyarrow.Table.from_arrays(columns, schema=self.schemas[sheet]))
+        self.batches[sheet] = []
+
+    def close(self):
+        for sheet in self.writers:
+            if self.batches[sheet]:
+                self.writeBatch(sheet)
+            self.writers[sheet].close()
+
+
+class MemorySink(Sink):
+    """Keep every sheet in memory as a list of rows, each row a dict of titles to values.
+    Used to answer the queries of the serve mode."""
+
+    def __init__(self, filename=None):
+        Sink.__init__(self, filename)
+        self.sheets = OrderedDict()
+
+    def addSheet(self, sheet, titles, lists=(), integers=()):
+        Sink.addSheet(self, sheet, titles, lists, integers)
+        self.sheets[sheet] = []
+
+    def writeRow(self, sheet, values):
+        self.sheets[sheet].append(OrderedDict(zip(self.titles[sheet], values)))
+
+    def close(self):
+        pass
+
+
+def getSink(outputformat, filename):
+    """Return the sink of an output format."""
+    sinks = {"xlsx": XlsxSink, "csv": CsvSink, "jsonl": JsonLinesSink, "parquet": ParquetSink}
+    return sinks[outputformat](filename)
+
+
+
+class Stats(object):
+    """Wall time, rows and peak memory growth of each phase of a run (parse, index, extract, write...).
+
+    Phases can be nested: while a phase runs, the one that started it is paused, so the
+    extraction of the rules is not counted again in the writing that pulls them. The peak
+    memory of the process only grows, so each phase gets how much it grew while it was
+    counting, and the phases after the largest one are not all given its peak. With
+    profile, each phase also gets its own cProfile.Profile, paused the same way."""
+
+    def __init__(self, profile=False):
+        self.phases = OrderedDict()
+        self.running = [] # Phases started and not stopped, the last one is counting.
+        self.profile = profile
+        self.profiles = {}
+        self.started = time.time()
+        self.peak = 0 # Peak memory when the running phase last resumed or was paused.
+
+    def start(self, phase):
+        """Start or resume counting the time of a phase, pausing the running one."""
+        if self.running:
+            self.pause(self.running[-1])
+        else:
+            self.peak = getPeakMemory() # Growth between phases is nobody's.
+        self.phases.setdefault(phase, {"seconds": 0.0, "rows": 0, "peak_growth_mb": 0.0})
+        self.running.append(phase)
+        self.resume(phase)
+
+    def stop(self, phase, rows=0):
+        """Stop counting a phase, add rows to it and resume the phase it paused."""
+        self.pause(phase)
+        self.running.pop()
+        self.phases[phase]["rows"] += rows
+        if self.running:
+            self.resume(self.running[-1])
+
+    def pause(self, phase):
+        self.phases[phase]["seconds"] += time.time() - self.phases[phase]["resumed"]
+        peak = getPeakMemory()
+        self.phases[phase]["peak_growth_mb"] += peak - self.peak
+        self.peak = peak
+        if self.profile:
+            self.profiles[phase].disable()
+
+    def resume(self, phase):
+        self.phases[phase]["resumed"] = time.time()
+        if self.profile:
+            self.profiles.setdefault(phase, cProfile.Profile()).enable()
+
+    def measure(self, phase, iterable):
+        """Yield the items of iterable, counting the time spent getting each one in a phase."""
+        iterator = iter(iterable)
+        while True:
+            self.start(phase)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.stop(phase)
+                return
+            self.stop(phase, 1)
+            yield item
+
+    def getSummary(self):
+        """Return the phases as a dict ready to be written as JSON."""
+        summary = OrderedDict([("command", sys.argv), ("seconds", round(time.time() - self.started, 3)), ("peak_mb", getPeakMemory()),
+                               ("phases", OrderedDict())])
+        for phase, measures in self.phases.items():
+            summary["phases"][phase] = OrderedDict([("seconds", round(measures["seconds"], 3)), ("rows", measures["rows"]),
+                                                    ("rows_per_second", int(measures["rows"] / measures["seconds"]) if measures["seconds"] and measures["rows"] else None),
+                                                    ("peak_growth_mb", round(measures["peak_growth_mb"], 1))])
+        return summary
+
+    def write(self, filename):
+        """Print the phases, write them as JSON to filename and the profiles next to it."""
+        summary = self.getSummary()
+        print "%-10s %10s %10s %12s %10s" % ("Phase", "Seconds", "Rows", "Rows/s", "Peak +MB")
+        for phase, measures in summary["phases"].items():
+            print "%-10s %10.3f %10d %12s %10.1f" % (phase, measures["seconds"], measures["rows"], measures["rows_per_second"] or "", measures["peak_growth_mb"])
+        print "%-10s %10.3f" % ("total", summary["seconds"])
+        print "Peak memory %.1f MB" % summary["peak_mb"]
+        for phase, profile in self.profiles.items():
+            summary["phases"][phase]["profile"] = os.path.splitext(filename)[0] + "_" + phase + ".prof" # Read with python -m pstats.
+            profile.dump_stats(summary["phases"][phase]["profile"])
+        with open(filename, "w") as statsfile:
+            json.dump(summary, statsfile, indent=2)
+        print "Stats written to", filename
+
+def getPeakMemory():
+    """Return the peak resident memory of the process in MB."""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1) # KB on Linux.
+
+
+
+class ObjectIndex(object):
+    """Index of the objects defined in the XML document, built in a single pass.
+
+    Objects are stored by type and name, and for each name by scope: "shared" or the
+    name of the device group or vsys where the object is defined."""
+    types = ("address", "address-group", "service", "service-group", "application", "application-group", "tag", "schedule", "zone")
+
+    def __init__(self, document):
+        """Walk the document once and index every object entry."""
+        self.objects = {}
+        self.entries = {}
+        for kind in self.types:
+            self.objects[kind] = {}
+            self.entries[kind] = []
+        for container in document.iter(*self.types):
+            for entry in container:
+                if entry.tag != "entry": # Rules also have <service>, <application> or <tag> with members.
+                    continue
+                name = entry.attrib.get("name")
+                self.objects[container.tag].setdefault(name, OrderedDict())[getScope(entry)] = entry
+                self.entries[container.tag].append(entry)
+
+    def getEntries(self, kind):
+        """Return all entries of one object type in document order."""
+        return self.entries[kind]
+
+    def get(self, kind, name, scope):
+        """Return the entry with that name defined in a concrete scope, or None."""
+        return self.objects[kind].get(name, {}).get(scope)
+
+
+class StreamedObjects(object):
+    """The address objects and address groups of a streamed config file, looked up by
+    GroupResolver like an ObjectIndex.
+
+    streamconfig clears every entry once it is consumed, so the groups are kept as detached
+    copies and the address objects as their records: the entries GroupResolver.getObjects
+    returns for them are ObjectRecords."""
+
+    def __init__(self):
+        self.objects = {"address": {}, "address-group": {}}
+        self.parents = {}
+
+    def add(self, kind, entry):
+        """Keep an address or address-group entry yielded by streamconfig."""
+        name = entry.attrib.get("name")
+        if kind == "address":
+            self.objects[kind].setdefault(name, OrderedDict())[getScope(entry)] = getObjectRecord(entry) # All -r and -o write of it.
+        elif kind == "address-group":
+            self.objects[kind].setdefault(name, OrderedDict())[getScope(entry)] = copy.deepcopy(entry)
+
+    def get(self, kind, name, scope):
+        """Return the entry with that name defined in a concrete scope, or None, like ObjectIndex.get."""
+        return self.objects.get(kind, {}).get(name, {}).get(scope)
+
+
+
+class GroupResolver(object):
+    """Expand address-groups and service-groups into the objects they contain.
+
+    Names are looked up the way PAN-OS does: first in the scope where they are used, then
+    in the parent device groups and finally in shared. Every group is flattened once and
+    the result memoized, so a group used by thousands of rules costs a single expansion."""
+    families = {"address": ("address", "address-group"), "service": ("service", "service-group"),
+                "application": ("application", "application-group")}
+    members = {"address-group": ("static/member", "member"), "service-group": ("members/member", "member"),
+               "application-group": ("members/member", "member")} # PAN-OS 6 groups have no static/members level.
+
+    def __init__(self, objectindex, parents):
+        """parents maps each device group to its parent device group."""
+        self.objectindex = objectindex
+        self.parents = parents
+        self.chains = {}
+        self.found = {}
+        self.expanded = {}
+        self.names = {}
+        self.partial = set() # Groups being expanded whose result misses a loop that was cut.
+        self.loops = set()
+
+    def getChain(self, scope):
+        """Return the scopes searched for a name used in scope, closest first."""
+        if scope not in self.chains:
+            chain = []
+            parent = scope
+            while parent is not None and parent != "shared" and parent not in chain:
+                chain.append(parent)
+                parent = self.parents.get(parent)
+            chain.append("shared")
+            self.chains[scope] = chain
+        return self.chains[scope]
+
+    def lookup(self, family, name, scope):
+        """Return (kind, scope, entry) of the object a name used in scope refers to, or None."""
+        key = (family, name, scope)
+        if key not in self.found:
+            self.found[key] = None
+            for where, kind in [(where, kind) for where in self.getChain(scope) for kind in self.families[family]]:
+                entry = self.objectindex.get(kind, name, where)
+                if entry is not None:
+                    self.found[key] = kind, where, entry
+                    break
+        return self.found[key]
+
+    def expand(self, family, name, scope):
+        """Return the names of the objects a member used in scope expands to, without duplicates.
+
+        Anything that is not a group (objects, "any", literal addresses) expands to itself, and so
+        does a group without static members, like a dynamic address group."""
+        found = self.lookup(family, name, scope)
+        if found is None or found[0] not in self.members:
+            return (name,)
+        key = found[:2] + (name,)
+        if key not in self.names:
+            self.names[key] = tuple(OrderedDict.fromkeys(leaf for leaf, where in self.getLeaves(family, name, scope)))
+        return self.names[key]
+
+    def getLeaves(self, family, name, scope, resolving=None):
+        """Return the (name, scope) of the objects a member used in scope expands to, like expand,
+        scope being where the name is looked up: the scope of the group that contains it. Two
+        groups can contain the same name and mean objects of different scopes."""
+        found = self.lookup(family, name, scope)
+        if found is None or found[0] not in self.members:
+            return ((name, scope),)
+        kind, where, entry = found
+        key = (kind, where, name)
+        if key in self.expanded:
+            return self.expanded[key]
+        if resolving is None:
+            resolving = [] # The groups being expanded, outermost first.
+        if key in resolving:
+            if key not in self.loops:
+                self.loops.add(key)
+                print >> sys.stderr, "Loop found in %s %s, ignoring it" % (kind, name)
+            self.partial.update(resolving[resolving.index(key) + 1:]) # The groups inside the loop miss this one.
+            return ()
+        resolving.append(key)
+        leaves = []
+        seen = set()
+        members = [member for path in self.members[kind] for member in entry.findall(path)]
+        for member in members:
+            for leaf in self.getLeaves(family, member.text, where, resolving):
+                if leaf not in seen:
+                    seen.add(leaf)
+                    leaves.append(leaf)
+        resolving.pop()
+        leaves = tuple(leaves) if members else ((name, where),) # A loop alone leaves a group empty, not itself.
+        if key in self.partial:
+            self.partial.discard(key) # Expanded again from its own members the next time.
+        else:
+            self.expanded[key] = leaves
+        return leaves
+
+    def getObjects(self, family, name, scope):
+        """Return the (kind, scope, entry) of the objects a member used in scope expands to, each
+        looked up where PAN-OS finds it, leaving out what is not an object (literal addresses,
+        any, dynamic groups...)."""
+        objects = []
+        for leaf, where in self.getLeaves(family, name, scope):
+            found = self.lookup(family, leaf, where)
+            if found is not None and found[0] == self.families[family][0]:
+                objects.append(found)
+        return objects
+
+
+
+class UsageIndex(object):
+    """Reverse index from object names to the rules that use them.
+
+    Built once from every rules/entry of the document. Any member of a rule counts
+    (zones, addresses, applications, services, tags...), and an object contained in an
+    address, service or application group is also used by the rules that use the group."""
+    groups = ("address-group", "service-group", "application-group")
+
+    def __init__(self, document, objectindex):
+        """Walk the rules once, then the groups of the object index."""
+        self.direct = {}
+        self.containedby = {}
+        self.rules = {}
+        self.partial = set() # Names being resolved whose rules miss a loop that was cut.
+        self.order = {}
+        for rules in document.iter("rules"):
+            for entry in rules:
+                if entry.tag != "entry":
+                    continue
+                self.order[entry] = len(self.order)
+                for member in list(entry.iter("member")) + entry.findall("schedule"): # The schedule is a name, not a member.
+                    used = self.direct.setdefault(member.text, [])
+                    if not used or used[-1] is not entry: # A rule can use the same name in several fields.
+                        used.append(entry)
+        for kind in self.groups:
+            for entry in objectindex.getEntries(kind):
+                for member in entry.iter("member"): # static/member, members/member or member.
+                    self.containedby.setdefault(member.text, set()).add(entry.attrib.get("name"))
+
+    def getRules(self, name, resolving=None):
+        """Return the rule entries that use an object, directly or through groups, in document order."""
+        if name in self.rules:
+            return self.rules[name]
+        if resolving is None:
+            resolving = [] # The names being resolved, first one first.
+        if name in resolving:
+            self.partial.update(resolving[resolving.index(name) + 1:]) # The groups inside the loop miss its rules.
+            return []
+        resolving.append(name)
+        found = set(self.direct.get(name, []))
+        for group in self.containedby.get(name, ()):
+            found.update(self.getRules(group, resolving))
+        resolving.pop()
+        rules = sorted(found, key=self.order.get)
+        if name in self.partial:
+            self.partial.discard(name) # Resolved again the next time.
+        else:
+            self.rules[name] = rules
+        return rules
+
+    def findRules(self, names):
+        """Return the rule entries that use any of the objects, in document order."""
+        found = set()
+        for name in names:
+            found.update(self.getRules(name))
+        return sorted(found, key=self.order.get)
+
+    def isUsed(self, name):
+        """Return True if any rule uses the object."""
+        return len(self.getRules(name)) > 0
+
+
+
+class AddressIndex(object):
+    """Sorted interval index from IPv4 addresses to the address objects that contain them.
+
+    The ip-netmask and ip-range of every address object, and the addresses used in rules
+    without an object, are cut into sorted non-overlapping segments, each with the objects that
+    cover all of it. Objects are (name, scope where they are defined), and every rule is indexed
+    under the objects its source and destination expand to, looked up in the scope of the rule,
+    so a name defined in several scopes only brings the rules using each one. A lookup is a
+    binary search, plus the rules with any source or destination."""
+
+    def __init__(self, rules, objectindex, resolver):
+        """Build the segments from the objects and the members of rules, (entries, rulesection,
+        rulestype, device) tuples like walkRules yields."""
+        self.rules = {}
+        self.users = {} # (name, scope where it is defined, None for addresses without an object) -> rule entries.
+        self.order = {}
+        self.anyrules = [] # Rules matching every address.
+        for entries, rulesection, rulestype, device in rules:
+            self.order[entries] = len(self.order)
+            members = [member.text for field in ("source", "destination") for member in entries.iterfind(field + "/member")]
+            if "any" in members:
+                self.anyrules.append(entries)
+            for member in members:
+                for leaf, where in resolver.getLeaves("address", member, device.attrib.get("name")):
+                    found = resolver.lookup("address", leaf, where)
+                    used = self.users.setdefault((leaf, found[1] if found is not None else None), [])
+                    if not used or used[-1] is not entries: # A rule can use the same object in both fields.
+                        used.append(entries)
+
+        intervals = []
+        for entry in objectindex.getEntries("address"):
+            for value in entry.findall("ip-netmask") + entry.findall("ip-range"):
+                interval = getInterval(value.text)
+                if interval is not None:
+                    intervals.append(interval + ((entry.attrib.get("name"), getScope(entry)),))
+        for name, scope in self.users:
+            if scope is None:
+                interval = getInterval(name) # 10.1.1.0/24 used directly in a rule.
+                if interval is not None:
+                    intervals.append(interval + ((name, scope),))
+        self.boundaries = sorted(set([first for first, last, key in intervals] + [last + 1 for first, last, key in intervals]))
+        self.segments = [[] for boundary in self.boundaries] # Objects covering boundaries[i] to boundaries[i + 1] - 1.
+        for first, last, key in intervals:
+            for i in range(bisect.bisect_left(self.boundaries, first), bisect.bisect_left(self.boundaries, last + 1)):
+                self.segments[i].append((last, key))
+
+    def find(self, first, last):
+        """Return the (name, scope) of the objects that contain every address from first to last."""
+        i = bisect.bisect_right(self.boundaries, first) - 1
+        if i < 0:
+            return []
+        return [key for end, key in self.segments[i] if end >= last]
+
+    def getRules(self, address):
+        """Return (object names, rule entries in order) matching an IPv4 address, network or
+        range, or None if it is not one."""
+        interval = getInterval(address)
+        if interval is None:
+            return None
+        objects = self.find(*interval)
+        key = tuple(objects) # Every address of a segment matches the same rules.
+        if key not in self.rules:
+            found = set(self.anyrules)
+            for objectkey in objects:
+                found.update(self.users.get(objectkey, ()))
+            self.rules[key] = sorted(found, key=self.order.get)
+        return list(OrderedDict.fromkeys(name for name, scope in objects)), self.rules[key]
+
+
+
+class ShadowAnalyzer(object):
+    """Find the security rules that an earlier rule of the same firewall fully covers.
+
+    Rules are compared in evaluation order (pre-rulebase, rulebase, post-rulebase). A rule is
+    covered when an earlier enabled rule matches at least the same zones, users, URL categories,
+    applications, services, HIP profiles and addresses, with groups expanded: it is Shadowed if
+    the earlier rule has another action and Redundant if it has the same one.
+
+    Every field is indexed once as one boolean array per member telling which rules match it,
+    and IPv4 addresses as arrays of integer intervals, so each rule is checked against all the
+    earlier ones with a few NumPy operations, starting with the zones that prune most candidates.
+    Values that are not IPv4 (fqdn, IPv6, dynamic groups...) only cover the same value."""
+    sections = {"pre-rulebase": 0, "rulebase": 1, "post-rulebase": 2}
+    fields = (("from", None), ("to", None), ("source-user", None), ("category", None), ("application", "application"),
+              ("service", "service"), ("hip-profiles", None), ("source-hip", None), ("destination-hip", None)) # (field, group family)
+    addresses = ("source", "destination")
+    lastaddress = 2 ** 32 - 1
+
+    def __init__(self, objectindex, resolver):
+        global numpy
+        try:
+            import numpy # Only needed for --shadowed.
+        except ImportError:
+            sys.exit("numpy is needed to find shadowed rules. Stopping execution")
+        self.objectindex = objectindex
+        self.resolver = resolver
+        self.intervals = {} # Address member of getMembers -> IPv4 interval or None.
+
+    def getFindings(self, document, virtual_or_deviceg, firewall=None):
+        """Yield (rule, finding, covering rule) for every covered security rule, where rules
+        are (entries, rulesection, device) tuples, firewall by firewall."""
+        rulebases = OrderedDict()
+        for entries, rulesection, rulestype, device in walkRules(document, virtual_or_deviceg, firewall):
+            if rulestype.tag == "security":
+                rulebases.setdefault(device.attrib.get("name"), []).append((entries, rulesection, device))
+        for rules in rulebases.values():
+            rules.sort(key=lambda rule: self.sections.get(rule[1].tag, 1)) # Stable, keeps the order within each section.
+            for found in self.analyze(rules):
+                yield found
+
+    def getMembers(self, field, family, scope):
+        """Return the expanded members of a rule field element, or None if the field is missing
+        or has any. Objects are (name, scope where they are defined), so the same name in two
+        scopes is two values. A field without members only matches the same empty field."""
+        if field is None:
+            return None
+        members = set()
+        for member in field.iterfind("member"):
+            if family is None:
+                leaves = ((member.text, None),)
+            else:
+                leaves = self.resolver.getLeaves(family, member.text, scope)
+            for leaf, where in leaves:
+                if leaf == "any":
+                    return None
+                found = self.resolver.lookup(family, leaf, where) if family is not None else None
+                members.add(leaf if found is None else (leaf, found[1]))
+        return members or set([None])
+
+    def getAddresses(self, field, scope):
+        """Return (values, intervals) of an address field element, values being the members that
+        are not IPv4, or None if the field matches any address."""
+        members = self.getMembers(field, "address", scope)
+        if members is None:
+            return None
+        values = set()
+        intervals = []
+        for member in members:
+            if member not in self.intervals:
+                interval = None
+                if not isinstance(member, tuple):
+                    interval = getInterval(member) # Addresses can be used without an object.
+                else:
+                    found = self.resolver.lookup("address", member[0], member[1])
+                    if found[0] == "address":
+                        for value in found[2].findall("ip-netmask") + found[2].findall("ip-range"):
+                            interval = getInterval(value.text)
+                self.intervals[member] = interval
+            if self.intervals[member] is None:
+                values.add(member)
+            else:
+                intervals.append(self.intervals[member])
+        return values, mergeIntervals(intervals)
+
+    def analyze(self, rules):
+        """Yield (rule, finding, covering rule) for the covered rules of one firewall in evaluation order."""
+        count = len(rules)
+        covering = numpy.zeros(count, bool) # Rules that can cover the next ones.
+        checked = numpy.zeros(count, bool) # Rules that are checked.
+        anys = OrderedDict() # Zones first, they prune the most.
+        indexes = {}
+        queries = []
+        owners = dict((field, []) for field in self.addresses)
+        starts = dict((field, []) for field in self.addresses)
+        ends = dict((field, []) for field in self.addresses)
+        for field in [field for field, family in self.fields] + list(self.addresses):
+            anys[field] = numpy.zeros(count, bool)
+            indexes[field] = {}
+
+        for i, (entries, rulesection, device) in enumerate(rules):
+            scope = device.attrib.get("name")
+            enabled = getText(entries, "disabled", "no") != "yes" and getText(entries, "negate-source", "no") != "yes" \
+                and getText(entries, "negate-destination", "no") != "yes"
+            checked[i] = enabled
+            covering[i] = enabled and entries.find("schedule") is None # Only active part of the time.
+            elements = dict((element.tag, element) for element in entries) # One pass instead of a find per field.
+            query = {}
+            for field, family in self.fields:
+                query[field] = self.getMembers(elements.get(field), family, scope)
+            for field in self.addresses:
+                query[field] = self.getAddresses(elements.get(field), scope)
+                if query[field] is None:
+                    intervals = [(0, self.lastaddress)]
+                else:
+                    intervals = query[field][1]
+                owners[field].extend([i] * len(intervals))
+                starts[field].extend(interval[0] for interval in intervals)
+                ends[field].extend(interval[1] for interval in intervals)
+            for field in anys:
+                values = query[field]
+                if field in self.addresses and values is not None:
+                    values = values[0]
+                if values is None:
+                    anys[field][i] = True
+                else:
+                    for value in values:
+                        indexes[field].setdefault(value, []).append(i)
+            queries.append(query)
+
+        for field in anys:
+            for value, found in indexes[field].items():
+                matches = anys[field].copy() # A rule with any matches every value.
+                matches[found] = True
+                indexes[field][value] = matches
+        offsets = {}
+        for field in self.addresses:
+            offsets[field] = numpy.searchsorted(numpy.array(owners[field], numpy.int64), numpy.arange(count + 1)) # Intervals of rule i are offsets[i]:offsets[i + 1].
+            starts[field] = numpy.array(starts[field], numpy.int64)
+            ends[field] = numpy.array(ends[field], numpy.int64)
+
+        for i, query in enumerate(queries):
+            if not checked[i]:
+                continue
+            candidates = covering[:i].copy()
+            for field in ("from", "to"): # On every earlier rule.
+                candidates &= self.getMatches(anys[field], indexes[field], query[field], i)
+            candidates = numpy.flatnonzero(candidates)
+            for field in anys: # Only on the few earlier rules left, as indexes.
+                if not len(candidates):
+                    break
+                if field in ("from", "to"):
+                    continue
+                values = query[field]
+                if field in self.addresses and values is not None:
+                    values = values[0]
+                candidates = candidates[self.getMatches(anys[field], indexes[field], values, candidates)]
+            for field in self.addresses:
+                if not len(candidates) or query[field] is None or not query[field][1]:
+                    continue
+                # Intervals of the candidates, owners[k] being the candidate that has interval positions[k].
+                lengths = offsets[field][candidates + 1] - offsets[field][candidates]
+                owners = numpy.repeat(numpy.arange(len(candidates)), lengths)
+                positions = numpy.repeat(offsets[field][candidates] - numpy.cumsum(lengths) + lengths, lengths) + numpy.arange(lengths.sum())
+                covered = numpy.zeros(len(candidates), numpy.int64)
+                for start, end in query[field][1]: # Intervals of a rule are merged, at most one contains it.
+                    contains = (starts[field][positions] <= start) & (ends[field][positions] >= end)
+                    covered += numpy.bincount(owners[contains], minlength=len(candidates))
+                candidates = candidates[covered == len(query[field][1])]
+            if len(candidates):
+                first = candidates[0]
+                if getText(rules[first][0], "action") == getText(rules[i][0], "action"):
+                    yield rules[i], "Redundant", rules[first]
+                else:
+                    yield rules[i], "Shadowed", rules[first]
+
+    def getMatches(self, anys, index, values, rules):
+        """Return which of the rules match every value, None meaning any. rules is the number
+        of rules from the first one, or an array with the indexes of the rules."""
+        if isinstance(rules, int):
+            rules = slice(rules)
+        if values is None:
+            return anys[rules]
+        matches = numpy.ones(len(anys[rules]), bool)
+        for value in values:
+            matches &= index.get(value, anys)[rules]
+        return matches
+
+
+class EffectivePolicy(object):
+    """Rules each device group really runs, in evaluation order: the shared pre-rules, the
+    pre-rules of every parent device group from the top, its own pre-rules and local rules,
+    then its own post-rules, the post-rules of the parents from the closest and the shared
+    post-rules. Every rule type (security, nat...) is a separate rulebase.
+
+    The pre and post rules inherited by a device group are built once from the ones of its
+    parent and memoized, so the leaves of a deep hierarchy share their ancestors' lists."""
+
+    def __init__(self, document, virtual_or_deviceg):
+        """Collect the rules of every rulebase, the shared ones and the device group hierarchy."""
+        self.parents = getHierarchy(document)
+        self.own = {} # (scope, rulesection) to an OrderedDict of rule type to rules.
+        self.scopes = []
+        self.pre = {}
+        self.post = {}
+        rulebases = list(getRulebases(document, virtual_or_deviceg))
+        for shared in document.iter("shared"):
+            if shared.getparent() is not None and shared.getparent().tag == "config": # Not a shared setting of something else.
+                rulebases = [(rules, rulesection, rulestype, shared) for rulesection in shared for rulestype in rulesection
+                             for rules in rulestype.iterfind("rules")] + rulebases
+        for rules, rulesection, rulestype, device in rulebases:
+            scope = device.attrib.get("name") if device.tag != "shared" else "shared"
+            if scope not in self.scopes and scope != "shared":
+                self.scopes.append(scope)
+            ruletypes = self.own.setdefault((scope, rulesection.tag), OrderedDict())
+            ruletypes.setdefault(rulestype.tag, []).extend((entries, rulesection, rulestype, device) for entries in rules.iterfind("entry"))
+        for scope in self.parents.keys() + self.parents.values():
+            if scope not in self.scopes:
+                self.scopes.append(scope) # Device groups without rules still inherit some.
+
+    def getParent(self, scope):
+        """Return the parent device group of a scope, "shared" at the top and None for shared."""
+        if scope == "shared":
+            return None
+        return self.parents.get(scope, "shared")
+
+    def getInherited(self, scope, rulesection, memo, resolving=None):
+        """Return the rules of a rule section that apply to a scope, by rule type. pre-rulebase
+        puts the parent's rules first, post-rulebase last."""
+        if scope in memo:
+            return memo[scope]
+        if resolving is None:
+            resolving = set()
+        resolving.add(scope)
+        parent = self.getParent(scope)
+        inherited = OrderedDict()
+        if parent is not None and parent not in resolving: # A loop in the hierarchy stops at the device group seen twice.
+            inherited = self.getInherited(parent, rulesection, memo, resolving)
+        own = self.own.get((scope, rulesection), {})
+        rules = OrderedDict()
+        for rulestype in list(inherited) + [rulestype for rulestype in own if rulestype not in inherited]:
+            if rulesection == "pre-rulebase":
+                rules[rulestype] = inherited.get(rulestype, ()) + tuple(own.get(rulestype, ()))
+            else:
+                rules[rulestype] = tuple(own.get(rulestype, ())) + inherited.get(rulestype, ())
+        memo[scope] = rules
+        return rules
+
+    def getRules(self, scope):
+        """Yield (effective order, (entries, rulesection, rulestype, device)) for every rule that applies
+        to a scope. The order starts again at 1 for each rule type."""
+        pre = self.getInherited(scope, "pre-rulebase", self.pre)
+        local = self.own.get((scope, "rulebase"), {})
+        post = self.getInherited(scope, "post-rulebase", self.post)
+        ruletypes = list(pre) + [rulestype for rulestype in list(local) + list(post) if rulestype not in pre]
+        for rulestype in OrderedDict.fromkeys(ruletypes):
+            rules = pre.get(rulestype, ()) + tuple(local.get(rulestype, ())) + post.get(rulestype, ())
+            for order, rule in enumerate(rules, 1):
+                yield order, rule
+
+
+class RuleCache(object):
+    """On-disk SQLite cache of the rules extracted by previous runs.
+
+    Rules are keyed by their scope (firewall, rule section and rule type) and name, and
+    stored with a hash of the canonical XML of the rules/entry and its scope. A rule whose
+    hash is unchanged reuses the stored record instead of being extracted again, and the
+    hashes of the previous run tell which rules were added, changed or removed since then."""
+
+    def __init__(self, filename):
+        """Open or create the cache and load the hashes and records of the previous run."""
+        self.created = not os.path.exists(filename)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS rules (firewall TEXT, rulesection TEXT, ruletype TEXT, name TEXT, "
+                                "hash TEXT, record BLOB, PRIMARY KEY (firewall, rulesection, ruletype, name))")
+        self.hashes = {} # (firewall, rulesection, ruletype, name) of every cached rule -> hash.
+        self.records = {} # hash -> pickled record without the resolved columns.
+        for firewall, rulesection, ruletype, name, digest, record in self.connection.execute("SELECT * FROM rules"):
+            self.hashes[(firewall, rulesection, ruletype, name)] = digest
+            self.records[digest] = record
+        self.seen = set()
+        self.stored = []
+        self.changes = []
+
+    def getRule(self, entries, rulesection, rulestype, device, resolver=None):
+        """Return the RuleRecord of a rule like getRule, from the cache if the rule is unchanged."""
+        key = (device.attrib.get("name"), rulesection.tag, rulestype.tag, entries.attrib.get("name"))
+        digest = hashlib.sha1(repr(key) + etree.tostring(entries, method="c14n")).hexdigest()
+        self.seen.add(key)
+        if digest in self.records:
+            # Groups can change without the rule changing, so the resolved columns are never cached.
+            return RuleRecord._make(cPickle.loads(str(self.records[digest])) + (getResolved(resolver, entries, "source", key[0]),
+                                                                             getResolved(resolver, entries, "destination", key[0])))
+        record = getRule(entries, rulesection, rulestype, device, resolver)
+        self.stored.append(key + (digest, sqlite3.Binary(cPickle.dumps(tuple(record[:-RuleRecord.resolvedcolumns]), 2))))
+        if key in self.hashes:
+            self.changes.append(("Changed",) + key)
+        else:
+            self.changes.append(("Added",) + key)
+        return record
+
+    def close(self, rulebases, firewall=None):
+        """Store the new and changed rules, drop the removed ones and the rules of scopes that are
+        no longer in the document, and return the changes as (change, firewall, rulesection, ruletype, name).
+
+        Only the rules of firewall, or of every firewall if it is None, were walked and can be
+        reported as removed. rulebases is the set of (firewall, rulesection, ruletype) of the
+        document, used to tell the other firewalls from the ones that no longer exist."""
+        deleted = []
+        evicted = 0
+        for key in sorted(self.hashes):
+            if key in self.seen:
+                continue
+            if firewall is None or key[0] == firewall:
+                self.changes.append(("Removed",) + key)
+            elif key[:3] in rulebases:
+                continue # Another firewall, not exported this time.
+            else:
+                evicted += 1
+            deleted.append(key)
+        self.connection.executemany("DELETE FROM rules WHERE firewall = ? AND rulesection = ? AND ruletype = ? AND name = ?", deleted)
+        self.connection.executemany("INSERT OR REPLACE INTO rules VALUES (?, ?, ?, ?, ?, ?)", self.stored)
+        self.connection.commit()
+        self.connection.close()
+        if evicted and verbose:
+            print "Evicted %d cached rules of scopes that no longer exist" % evicted
+        return self.changes
+
+
+class Snapshot(object):
+    """Compiled copy of what the exports need from a config file: the rules, the address
+    objects and the indexes used to find rules by name or object, so later runs do not
+    parse the XML.
+
+    The file is a set of pickled sections (and one pickle per rule) found through a header
+    at the end. It is memory mapped and each section, or rule, is only unpickled when it
+    is used, so -r or -o only load the few rules they write."""
+    version = 7
+
+    def __init__(self, filename):
+        """Map a snapshot file and read its header."""
+        self.file = open(filename, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        headerstart = struct.unpack("<Q", self.map[:8])[0]
+        self.header = cPickle.loads(self.map[headerstart:])
+        self.sections = {}
+        self.found = {}
+        self.partial = set()
+
+    def isValid(self, configfile, virtual_or_deviceg):
+        """Return True if the snapshot was compiled from this config file as it is now.
+
+        The file is only hashed when its modification time or size changed, so a file that
+        was touched or copied but has the same contents keeps its snapshot."""
+        if self.header.get("version") != self.version or self.header["virtual_or_deviceg"] != virtual_or_deviceg:
+            return False
+        if self.header["mtime"] == os.path.getmtime(configfile) and self.header["size"] == os.path.getsize(configfile):
+            return True
+        return self.header["hash"] == getFileHash(configfile)
+
+    def get(self, section):
+        """Return a section, unpickled the first time it is used."""
+        if section not in self.sections:
+            offset, length = self.header["sections"][section]
+            self.sections[section] = cPickle.loads(self.map[offset:offset + length])
+        return self.sections[section]
+
+    def getRecord(self, ruleid):
+        """Return the RuleRecord of one rule."""
+        records = self.get("records")
+        return RuleRecord._make(cPickle.loads(self.map[records[ruleid]:records[ruleid + 1]]))
+
+    def getName(self, ruleid):
+        """Return the name of one rule."""
+        return self.get("names")[ruleid]
+
+    def getRules(self, firewall=None, wanted=None):
+        """Yield the RuleRecord of each wanted rule like getRules, wanted being None, a set of
+        rule names or a function that takes the rule number."""
+        firewalls = self.get("firewalls")
+        names = self.get("names")
+        for ruleid in xrange(len(names)):
+            if firewall != None and firewalls[ruleid] != firewall:
+                continue
+            if wanted is None or (wanted(ruleid) if callable(wanted) else names[ruleid] in wanted):
+                yield self.getRecord(ruleid)
+
+    def findRules(self, names):
+        """Return the numbers of the rules that use any of the objects, directly or through groups, in order."""
+        found = set()
+        for name in names:
+            found.update(self.getUsers(name))
+        return sorted(found)
+
+    def getUsers(self, name, resolving=None):
+        """Return the numbers of the rules that use an object, like UsageIndex.getRules."""
+        if name in self.found:
+            return self.found[name]
+        if resolving is None:
+            resolving = []
+        if name in resolving:
+            self.partial.update(resolving[resolving.index(name) + 1:])
+            return set()
+        resolving.append(name)
+        found = set(self.get("direct").get(name, []))
+        for group in self.get("containedby").get(name, ()):
+            found.update(self.getUsers(group, resolving))
+        resolving.pop()
+        if name in self.partial:
+            self.partial.discard(name)
+        else:
+            self.found[name] = found
+        return found
+
+    def findObjects(self, member, scope):
+        """Return the ObjectRecords of the address objects a member of a rule of scope expands
+        to, like findbyobjectname."""
+        objects = self.get("objects")
+        return [ObjectRecord._make(objects[i]) for i in self.get("objectsused").get((member, scope), [])]
+
+    def getObjects(self):
+        """Yield the record of every object, like getObjects."""
+        for objectrecord in self.get("objects"):
+            yield ObjectRecord._make(objectrecord)
+        for kind, objectrecord in self.get("typedobjects"):
+            yield typedobjects[kind][0]._make(objectrecord)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def writeSnapshot(filename, configfile, virtual_or_deviceg, document, objectindex, resolver):
+    """Write the Snapshot of a parsed config file. Resolved columns are always compiled."""
+    usageindex = UsageIndex(document, objectindex)
+    sections = {"names": [], "firewalls": [], "records": [], "objectsused": {}, "direct": {}, "containedby": {}}
+    ruleids = {}
+    objects = objectindex.getEntries("address")
+    positions = dict((entry, i) for i, entry in enumerate(objects))
+    output = open(filename + ".tmp", "wb")
+    output.write(struct.pack("<Q", 0))
+    for entries, rulesection, rulestype, device in walkRules(document, virtual_or_deviceg):
+        record = getRule(entries, rulesection, rulestype, device, resolver)
+        ruleids[entries] = len(ruleids)
+        sections["names"].append(record.name)
+        sections["firewalls"].append(record.firewall)
+        sections["records"].append(output.tell())
+        output.write(cPickle.dumps(tuple(record), 2)) # Plain tuples, they do not depend on the module name.
+        for member in record.source + record.destination:
+            sections["objectsused"][(member, record.firewall)] = [positions[entry] for kind, where, entry in resolver.getObjects("address", member, record.firewall)]
+    sections["records"].append(output.tell()) # Rule i is records[i]:records[i + 1].
+    for name, entries in usageindex.direct.items():
+        sections["direct"][name] = [ruleids[entry] for entry in entries if entry in ruleids] # Rules that are exported.
+    for name, groups in usageindex.containedby.items():
+        sections["containedby"][name] = list(groups)
+    sections["objects"] = [tuple(getObjectRecord(entry)) for entry in objects]
+    sections["typedobjects"] = [(kind, tuple(typed[1](entry))) for kind, typed in typedobjects.items() for entry in objectindex.getEntries(kind)]
+
+    header = {"version": Snapshot.version, "virtual_or_deviceg": virtual_or_deviceg, "mtime": os.path.getmtime(configfile),
+              "size": os.path.getsize(configfile), "hash": getFileHash(configfile), "sections": {}}
+    for section, value in sections.items():
+        data = cPickle.dumps(value, 2)
+        header["sections"][section] = (output.tell(), len(data))
+        output.write(data)
+    headerstart = output.tell()
+    output.write(cPickle.dumps(header, 2))
+    output.seek(0)
+    output.write(struct.pack("<Q", headerstart))
+    output.close()
+    os.rename(filename + ".tmp", filename) # A run reading the old snapshot never sees half a file.
+
+def getFileHash(filename):
+    """Return the SHA-1 of a file, read in blocks."""
+    digest = hashlib.sha1()
+    with open(filename, "rb") as hashed:
+        for block in iter(lambda: hashed.read(1 << 20), ""):
+            digest.update(block)
+    return digest.hexdigest()
 
 def commandlineparser():
     """Select the proper arguments needed"""
@@ -248,82 +1195,868 @@ def commandlineparser():
     parser.add_argument('-f', '--firewall', required=False, help='Select a concrete Firewall Group or VSYS Name.')
     parser.add_argument('-v', '--virtualsystem', action="store_true", required=False, default=False, help='Enable if xml file has Virtual Systems instead of Device Groups')
 #    parser.add_argument('-n', '--nat', required=False, help='Nat rules')
-    parser.add_argument('-c', '--configfile', required=False, help='Introduce a concrete config file. By default config.xml is read')
+    parser.add_argument('-c', '--configfile', nargs="+", required=False, help='Introduce a concrete config file. By default config.xml is read. Several files or a glob export them all in parallel')
     parser.add_argument('-r', '--rulename', required=False, help='Introduce a concrete rulename to obtain a report for just one rule')
-    parser.add_argument('-o', '--objectname', required=False, help='Introduce a concrete object to obtain a report of all rules associated to that object')
+    parser.add_argument('-o', '--objectname', action="append", required=False, help='Introduce a concrete object to obtain a report of all rules associated to that object. Can be repeated')
+    parser.add_argument('--ip', action="append", required=False, help='Report the rules matching an IPv4 address, through every object and group that contains it or any. Can be repeated')
+    parser.add_argument('--cidr', action="append", required=False, help='Report the rules matching a whole IPv4 network or range (10.1.0.0/16, 10.1.1.1-10.1.1.9). Can be repeated')
+    parser.add_argument('--ipfile', required=False, help='Read the addresses, networks or ranges to look up from a file, one per line')
     parser.add_argument('-e', '--excelname', required=False, help='Select a concrete output filename')
+    parser.add_argument('-g', '--resolvegroups', action="store_true", required=False, default=False, help='Add Resolved Source and Resolved Destination columns with address groups expanded into their objects')
+    parser.add_argument('-u', '--unused', action="store_true", required=False, default=False, help='Add an Unused Objects sheet with the objects no rule uses')
+    parser.add_argument('--format', choices=["xlsx", "csv", "jsonl", "parquet"], default="xlsx", required=False, help='Output format. csv, jsonl and parquet write one file per sheet named after the output filename')
+    parser.add_argument('-a', '--alldevicegroups', action="store_true", required=False, default=False, help='Export every Device Group or VSYS as a separate task in parallel')
+    parser.add_argument('-b', '--batchoutput', choices=["combined", "sheets", "files"], default="combined", required=False, help='With several files or -a: one Rules sheet with the Firewall column (combined), one sheet per firewall (sheets) or one output per firewall (files)')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(), required=False, help='Number of processes used with several files or -a')
+    parser.add_argument('--shadowed', action="store_true", required=False, default=False, help='Add a Shadowed sheet with the security rules fully covered by an earlier rule (needs numpy)')
+    parser.add_argument('-i', '--incremental', nargs="?", const="", required=False, metavar="CACHEFILE", help='Reuse the rules that did not change since the previous run from a cache file and report the added, changed and removed rules. By default the cache is next to the output file')
+    parser.add_argument('--snapshot', nargs="?", const="", required=False, metavar="SNAPSHOTFILE", help='Compile the config file into a snapshot and answer the next exports, -r and -o from it without parsing the XML while the config file does not change. By default the snapshot is next to the config file')
+    parser.add_argument('--serve', required=False, metavar="[HOST:]PORT", help='Load the config files once and answer rule, object and export queries as JSON over HTTP, reloading the files when they change. Listens on 127.0.0.1 unless a host is given')
+    parser.add_argument('--effective', action="store_true", required=False, default=False, help='Add an Effective Policy sheet with the rules each device group runs, in order: shared, parent and own pre-rules, local rules, own, parent and shared post-rules')
+    parser.add_argument('--diff', required=False, metavar="OLDCONFIGFILE", help='Compare the config file with an older one and write the rules and objects added, removed and modified to Added, Removed and Modified sheets')
+    parser.add_argument('--columns', required=False, help='Comma separated rule columns to export, by title or field name ("name,source,destination" or "Rule Name,Source"). The other fields of the rules are not read')
+    parser.add_argument('--verbose', action="store_true", required=False, default=False, help='Print every rule and object found, as earlier versions did')
+    parser.add_argument('--stats', nargs="?", const="", required=False, metavar="STATSFILE", help='Print the time, rows, rows per second and peak memory growth of the parse, index, extract and write phases, and the peak memory of the run, and write them as JSON. By default next to the output file, ending in _stats.json')
+    parser.add_argument('--profile', action="store_true", required=False, default=False, help='Run each phase under cProfile and write one .prof file per phase next to the stats file. Implies --stats')
+    parser.add_argument('-s', '--stream', action="store_true", required=False, default=False, help='Read the config file incrementally instead of loading the whole tree. Keeps memory flat on very large exports')
     args = parser.parse_args()
 
-def getObjects(elementtree):
-    """ Get all objects from the xml file"""
-    objectrow=0
-    for address in elementtree.iter("address"):
-        #print address.tag
-        for entry in address:
-            objectrow +=1 
-            excelobjects.setObjectname(objectname=entry.attrib.get("name"))
-            #print entry.attrib.get("name")
-
-            for netmask in entry.findall('ip-netmask'):
-                excelobjects.setObjectvalue(netmask.text)
-
-            for fqdn in entry.findall('fqdn'):
-                excelobjects.setObjectvalue(fqdn.text)
-
-            for description in entry.findall('description'):
-                excelobjects.setObjectdescription(description.text)
-
-            if address.getparent().tag == "shared":
-                excelobjects.setObjectShared("yes")
-
-            excelobjects.writeObjectRow(objectrow)
-            excelobjects.newObjectRow()
-
-def findbyobjectname(elementtree2, objectfind, objectrow):
-
-    for address in elementtree2.iter("address"):
-        for entry in address.findall(".//*[@name='%s']" %objectfind):
-            objectrow+=1
+def getObjects(objectindex):
+    """ Get all objects from the xml file: the address objects, then every other type of typedobjects.
+    The entries come from the object index, so no type costs another walk of the document."""
+    for entry in objectindex.getEntries("address"):
+        yield getObjectRecord(entry)
+    for kind, (recordtype, getrecord) in typedobjects.items():
+        for entry in objectindex.getEntries(kind):
+            yield getrecord(entry)
+
+def getUnusedObjects(sink, objectindex, usageindex):
+    """Write the objects that no rule uses to the Unused Objects sheet."""
+    sink.addSheet("Unused Objects", ["Object Name", "Object Type", "Scope"])
+    for kind in objectindex.types:
+        for entry in objectindex.getEntries(kind):
+            if not usageindex.isUsed(entry.attrib.get("name")):
+                sink.writeRow("Unused Objects", [entry.attrib.get("name"), kind, getScope(entry)])
+
+def getShadowedRules(sink, document, virtual_or_deviceg, firewall, objectindex, resolver):
+    """Write the security rules covered by an earlier rule to the Shadowed sheet."""
+    sink.addSheet("Shadowed", ["Rule Name", "Firewall", "Rule Section", "Finding", "Covered By", "Covered By Section"])
+    analyzer = ShadowAnalyzer(objectindex, resolver)
+    for rule, finding, coveredby in analyzer.getFindings(document, virtual_or_deviceg, firewall):
+        sink.writeRow("Shadowed", [rule[0].attrib.get("name"), rule[2].attrib.get("name"), rule[1].tag, finding,
+                                   coveredby[0].attrib.get("name"), coveredby[1].tag])
+
+def getEffectivePolicy(sink, document, virtual_or_deviceg, firewall=None, resolver=None, columns=None):
+    """Write the effective rulebase of every device group, or only of firewall, to the Effective
+    Policy sheet, with only the rule fields of columns if given. Each rule is extracted once
+    however many device groups inherit it."""
+    titles = ["Defined In" if title == "Firewall" else title for title in RuleRecord.titles]
+    if columns is not None:
+        titles = [titles[i] for i in columns]
+    elif resolver is None:
+        titles = titles[:-RuleRecord.resolvedcolumns]
+    sink.addSheet("Effective Policy", ["Firewall", "Effective Order"] + titles, RuleRecord.lists, ["Effective Order"])
+    policy = EffectivePolicy(document, virtual_or_deviceg)
+    records = {}
+    for scope in ([firewall] if firewall != None else policy.scopes):
+        for order, rule in policy.getRules(scope):
+            if rule[0] not in records:
+                records[rule[0]] = getRule(*rule, resolver=resolver, columns=set(columns) if columns is not None else None)
+                if rule[3].tag == "shared":
+                    records[rule[0]] = records[rule[0]]._replace(firewall="shared")
+            if columns is not None:
+                sink.writeRow("Effective Policy", [scope, order] + [records[rule[0]][i] for i in columns])
+            else:
+                sink.writeRow("Effective Policy", [scope, order] + list(records[rule[0]][:len(titles)]))
+
+def getAddressLookup(sink, lookups, walked):
+    """Write the rules matching each address looked up to the Address Lookup sheet.
+
+    lookups are (address, object names, rule entries), walked the rule entries exported."""
+    sink.addSheet("Address Lookup", ["Address", "Objects", "Rule Name", "Firewall", "Rule Section", "Rule Type"], ["Objects"])
+    for address, names, rules in lookups:
+        names = tuple(names)
+        for entries in rules:
+            if entries in walked:
+                rulestype = entries.getparent().getparent()
+                rulesection = rulestype.getparent()
+                sink.writeRow("Address Lookup", [address, names, entries.attrib.get("name"), rulesection.getparent().attrib.get("name"),
+                                                 rulesection.tag, rulestype.tag])
+
+def getObjectRecord(entry):
+    """Return the Objects sheet row of one address entry."""
+    objectvalue = ""
+    objectFQDN = "no"
+    for netmask in entry.findall('ip-netmask') + entry.findall('ip-range') + entry.findall('ip-wildcard'):
+        objectvalue = netmask.text
+    for fqdn in entry.findall('fqdn'):
+        objectvalue = fqdn.text
+        objectFQDN = "yes"
+
+    objectdescription = ""
+    for description in entry.findall('description'):
+        objectdescription = description.text
+
+    objectscope = getScope(entry)
+    if objectscope == "shared":
+        objectshared = "yes"
+    else:
+        objectshared = "no"
+
+    return ObjectRecord(entry.attrib.get("name"), objectvalue, objectdescription, objectFQDN, objectshared, objectscope)
+
+def getAddressGroupRecord(entry):
+    """Return the Address Groups sheet row of one address-group entry."""
+    dynamic = entry.find("dynamic")
+    return AddressGroupRecord(entry.attrib.get("name"), "dynamic" if dynamic is not None else "static",
+                              getObjectMembers(entry, "static") + getObjectMembers(entry, "."), # PAN-OS 6 groups have no static level.
+                              getText(entry, "dynamic/filter"), getText(entry, "description"), getObjectMembers(entry, "tag"), getScope(entry))
+
+def getServiceRecord(entry):
+    """Return the Services sheet row of one service entry."""
+    protocol, port, sourceport = None, None, None
+    for element in entry.iterfind("protocol/*"): # tcp, udp or sctp.
+        protocol, port, sourceport = element.tag, getText(element, "port"), getText(element, "source-port")
+    return ServiceRecord(entry.attrib.get("name"), protocol, port, sourceport, getText(entry, "description"), getObjectMembers(entry, "tag"), getScope(entry))
+
+def getServiceGroupRecord(entry):
+    """Return the Service Groups sheet row of one service-group entry."""
+    return ServiceGroupRecord(entry.attrib.get("name"), getObjectMembers(entry, "members") + getObjectMembers(entry, "."), getObjectMembers(entry, "tag"), getScope(entry))
+
+def getApplicationGroupRecord(entry):
+    """Return the Application Groups sheet row of one application-group entry."""
+    return ApplicationGroupRecord(entry.attrib.get("name"), getObjectMembers(entry, "members") + getObjectMembers(entry, "."), getScope(entry))
+
+def getTagRecord(entry):
+    """Return the Tags sheet row of one tag entry."""
+    return TagRecord(entry.attrib.get("name"), getText(entry, "color"), getText(entry, "comments"), getScope(entry))
+
+def getScheduleRecord(entry):
+    """Return the Schedules sheet row of one schedule entry: daily, weekly or non-recurring."""
+    scheduletype = None
+    times = []
+    for recurrence in entry.iterfind("schedule-type/*"):
+        if recurrence.tag == "recurring":
+            for period in recurrence: # daily, or weekly with one element per day.
+                scheduletype = period.tag
+                if period.tag == "weekly":
+                    times += [day.tag + " " + member.text for day in period for member in day.iterfind("member")]
+                else:
+                    times += getObjectMembers(recurrence, period.tag)
+        else:
+            scheduletype = recurrence.tag
+            times += getObjectMembers(entry, "schedule-type/" + recurrence.tag)
+    return ScheduleRecord(entry.attrib.get("name"), scheduletype, tuple(times), getScope(entry))
+
+def getObjectMembers(entry, field):
+    """Return the members of an object field as a tuple, names with accents kept as unicode."""
+    return tuple([member.text for member in entry.iterfind(field + "/member")])
+
+typedobjects = OrderedDict([("address-group", (AddressGroupRecord, getAddressGroupRecord)), ("service", (ServiceRecord, getServiceRecord)),
+                            ("service-group", (ServiceGroupRecord, getServiceGroupRecord)), ("application-group", (ApplicationGroupRecord, getApplicationGroupRecord)),
+                            ("tag", (TagRecord, getTagRecord)), ("schedule", (ScheduleRecord, getScheduleRecord))]) # Sheets after Objects, in this order.
+
+def getScope(entry):
+    """Return "shared" or the device group or vsys name where an object is defined."""
+    scope = entry.getparent().getparent()
+    if scope is None or scope.tag == "shared":
+        return "shared"
+    return scope.attrib.get("name", scope.tag)
+
+def getInterval(value):
+    """Return the (first, last) integers of an IPv4 address, network or range, or None."""
+    if value is None:
+        return None
+    try:
+        if "-" in value:
+            first, last = value.split("-", 1)
+            if getAddressNumber(first) > getAddressNumber(last):
+                return None
+            return getAddressNumber(first), getAddressNumber(last)
+        address, mask, bits = value.partition("/")
+        first = getAddressNumber(address)
+        size = 2 ** (32 - int(bits or 32))
+        if not 1 <= size <= 2 ** 32:
+            return None
+        first -= first % size
+        return first, first + size - 1
+    except ValueError:
+        return None
+
+def getAddressNumber(address):
+    """Return the integer of a dotted IPv4 address. Raises ValueError if it is not one."""
+    octets = [int(octet) for octet in address.strip().split(".")]
+    if len(octets) != 4 or not all(0 <= octet <= 255 for octet in octets):
+        raise ValueError(address)
+    return (octets[0] << 24) + (octets[1] << 16) + (octets[2] << 8) + octets[3]
+
+def mergeIntervals(intervals):
+    """Return the sorted intervals with the overlapping and adjacent ones merged."""
+    merged = []
+    for first, last in sorted(intervals):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+def getHierarchy(document):
+    """Return a dict with the parent of every device group that has one."""
+    parents = {}
+    for parent in document.iter("parent-dg"): # readonly/dg-meta-data/dg-info or readonly/devices/.../device-group
+        if parent.text is not None:
+            parents[parent.getparent().attrib.get("name")] = parent.text
+    return parents
+
+def streamconfig(configfile, virtual_or_deviceg, firewall=None):
+    """Read the config file with iterparse and yield ("rule", entry), (object type, entry)
+    for the address objects and the types of typedobjects, and ("parent-dg", element) for the
+    device group hierarchy, as soon as each element is complete.
+
+    Everything already consumed is cleared from the partial tree so memory stays flat
+    whatever the size of the file. Ancestors of the current entry are still attached,
+    so entry.getparent() can be used to get its rulebase, device group or vsys."""
+    capturing = None # Entry being built. Nothing below it is cleared until it is yielded.
+    for event, elem in etree.iterparse(configfile, events=("start", "end"), huge_tree=True):
+        if event == "start":
+            if capturing is None:
+                parent = elem.getparent()
+                if parent is None:
+                    continue
+                if (parent.tag == "address" or parent.tag in typedobjects) and elem.tag == "entry":
+                    capturing = elem
+                elif elem.tag == "parent-dg":
+                    capturing = elem
+                elif parent.tag == "rules" and elem.tag == "entry":
+                    ancestors = list(parent.iterancestors()) # rulestype, rulesection, device, device-group/vsys...
+                    if len(ancestors) > 3 and ancestors[2].attrib.get("name") is not None \
+                            and (firewall == None or ancestors[2].attrib.get("name") == firewall) \
+                            and virtual_or_deviceg in [ancestor.tag for ancestor in ancestors[3:]]:
+                        capturing = elem
+            continue
+
+        if elem is capturing:
+            if elem.getparent().tag == "rules":
+                yield "rule", elem
+            elif elem.tag == "parent-dg":
+                yield "parent-dg", elem
+            else:
+                yield elem.getparent().tag, elem
+            capturing = None
+        elif capturing is not None:
+            continue # Still inside an entry, keep its children.
+
+        elem.clear() # Consumed (or not needed), drop its children and the siblings before it.
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+def getRulebases(document, virtual_or_deviceg, firewall=None):
+    """Yield (rules, rulesection, rulestype, device) for every rules element of the document, in document order."""
+    for config in document: # Start after root (result)
+        for devices in config.iter(virtual_or_deviceg): #depending of xml file value here can be "device-group" or "vsys1"
+            for device in devices.iterfind("entry"): # Only the device groups or vsys, not every rule and object below them.
+                if firewall != None and device.attrib.get("name") != firewall:
+                    continue
+                for rulesection in device: # pre-rulebase, post-rulebase or rulebase
+                    for rulestype in rulesection: # security, nat, decryption...
+                        for rules in rulestype.iterfind("rules"):
+                            yield rules, rulesection, rulestype, device
+
+def walkRules(document, virtual_or_deviceg, firewall=None, wanted=None):
+    """Walk every rulebase of the document once and yield (entries, rulesection, rulestype, device)
+    for each rule that is wanted, in document order."""
+    for rules, rulesection, rulestype, device in getRulebases(document, virtual_or_deviceg, firewall):
+        for entries in rules.iterfind("entry"): # Only the rules, not the named entries inside them (target devices).
+            if isWanted(entries, wanted):
+                yield entries, rulesection, rulestype, device
+
+def isWanted(entries, wanted):
+    """wanted is None for every rule, a set of rule names or a function that takes the rule entry."""
+    if wanted is None:
+        return True
+    if callable(wanted):
+        return wanted(entries)
+    return entries.attrib.get("name") in wanted
+
+def findbyobjectname(resolver, objectfind, scope):
+    """Yield the address objects a member used in scope expands to, the ones PAN-OS uses."""
+    for kind, where, entry in resolver.getObjects("address", objectfind, scope):
+        if verbose:
             print entry.attrib.get("name")
-
-            for netmask in entry.findall('ip-netmask'):
-                excelobjects.setObjectvalue(netmask.text)
-
-            for fqdn in entry.findall('fqdn'):
-                excelobjects.setObjectvalue(fqdn.text)
-
-            for description in entry.findall('description'):
-                excelobjects.setObjectdescription(description.text)
-
-            if entry.getparent().tag == "shared":
-                excelobjects.setObjectShared("yes")
-
-            excelobjects.writeObjectRow(objectrow)
-            excelobjects.newObjectRow()
-    return objectrow
-
+        yield getObjectRecord(entry)
+
+
+
+def getRule(entries, rulesection, rulestype, device, resolver=None, columns=None):
+    """Return the RuleRecord of one rules/entry element and its context. columns are the
+    indexes of the fields to decode, the others are left as None. All of them by default."""
+    if columns is None:
+        return RuleRecord._make([decoder(entries, rulesection, rulestype, device, resolver) for decoder in ruledecoders])
+    return RuleRecord._make([decoder(entries, rulesection, rulestype, device, resolver) if i in columns else None
+                             for i, decoder in enumerate(ruledecoders)])
+
+ruledecoders = ( # How each field of RuleRecord is read, in the same order.
+    lambda entries, rulesection, rulestype, device, resolver: entries.attrib.get("name"), # Used attrib.get since name is a value within the tag.
+    lambda entries, rulesection, rulestype, device, resolver: getMembers(entries, "from"),
+    lambda entries, rulesection, rulestype, device, resolver: getMembers(entries, "to"),
+    lambda entries, rulesection, rulestype, device, resolver: getMembers(entries, "source"),
+    lambda entries, rulesection, rulestype, device, resolver: getTranslation(entries, "source-translation"),
+    lambda entries, rulesection, rulestype, device, resolver: getMembers(entries, "destination"),
+    lambda entries, rulesection, rulestype, device, resolver: getTranslation(entries, "destination-translation"),
+    lambda entries, rulesection, rulestype, device, resolver: getMembers(entries, "application"),
+    lambda entries, rulesection, rulestype, device, resolver: getMembers(entries, "service"),
+    lambda entries, rulesection, rulestype, device, resolver: getMembers(entries, "hip-profiles"),
+    lambda entries, rulesection, rulestype, device, resolver: getText(entries, "action"),
+    lambda entries, rulesection, rulestype, device, resolver: getText(entries, "description"),
+    lambda entries, rulesection, rulestype, device, resolver: getText(entries, "log-start"),
+    lambda entries, rulesection, rulestype, device, resolver: getText(entries, "log-end"),
+    lambda entries, rulesection, rulestype, device, resolver: getMembers(entries, "tag"),
+    lambda entries, rulesection, rulestype, device, resolver: getMembers(entries, "profile-settings"),
+    lambda entries, rulesection, rulestype, device, resolver: getText(entries, "disabled", "no"), # Set to no since the PAN might return nothing for permit.
+    lambda entries, rulesection, rulestype, device, resolver: getText(entries, "schedule"),
+    lambda entries, rulesection, rulestype, device, resolver: rulesection.tag,
+    lambda entries, rulesection, rulestype, device, resolver: rulestype.tag,
+    lambda entries, rulesection, rulestype, device, resolver: device.attrib.get("name"),
+    lambda entries, rulesection, rulestype, device, resolver: getResolved(resolver, entries, "source", device.attrib.get("name")),
+    lambda entries, rulesection, rulestype, device, resolver: getResolved(resolver, entries, "destination", device.attrib.get("name")))
+
+def getMembers(entries, field):
+    """Return the members of a rule field as a tuple."""
+    return tuple([str(members.text) for members in entries.iterfind(field + "/member")])
+
+def getText(entries, field, default=None):
+    """Return the text of a single-valued rule field."""
+    text = default
+    for element in entries.iterfind(field):
+        text = element.text
+    return text
+
+def getTranslation(entries, field):
+    """Return the values of a NAT source-translation or destination-translation block."""
+    values = []
+    for translation in entries.iterfind(field):
+        for members in translation:
+            if members.text is not None:
+                values.append(str(members.text))
+            for submembers in members:
+                if submembers.text is not None:
+                    values.append(str(submembers.text))
+                for last in submembers:
+                    if last.text is not None:
+                        values.append(str(last.text))
+    return tuple(values)
+
+def getResolved(resolver, entries, field, scope):
+    """Return the members of a rule field with address groups expanded, or () without a resolver."""
+    if resolver is None:
+        return ()
+    leaves = []
+    for members in entries.iterfind(field + "/member"):
+        leaves.extend(resolver.expand("address", members.text, scope)) # Object names, with accents kept as unicode.
+    return tuple(leaves)
+
+def getRules(document, virtual_or_deviceg, firewall=None, wanted=None, resolver=None, cache=None, columns=None):
+    """Yield a RuleRecord for each wanted rule of the document, in document order."""
+    return getRecords(walkRules(document, virtual_or_deviceg, firewall, wanted), resolver, cache, columns)
+
+def getRecords(rules, resolver=None, cache=None, columns=None):
+    """Yield a RuleRecord for each (entries, rulesection, rulestype, device) of rules, with only
+    the fields of columns decoded, like getRule. The cache always keeps whole records."""
+    for entries, rulesection, rulestype, device in rules:
+        if cache is not None:
+            yield cache.getRule(entries, rulesection, rulestype, device, resolver)
+        else:
+            yield getRule(entries, rulesection, rulestype, device, resolver, columns)
+
+def getColumns(names, resolvegroups=False):
+    """Return the indexes of the RuleRecord fields of a comma separated list of column titles
+    ("Rule Name") or field names (name), in that order."""
+    fields = {}
+    for i, (field, title) in enumerate(zip(RuleRecord._fields, RuleRecord.titles)):
+        fields[field.lower()] = fields[title.lower()] = i
+    columns = []
+    for name in names.split(","):
+        if name.strip().lower() not in fields:
+            sys.exit("Unknown column %s, the columns are %s. Stopping execution" % (name.strip(), ", ".join(RuleRecord._fields)))
+        columns.append(fields[name.strip().lower()])
+    if not resolvegroups and len(RuleRecord.titles) - max(columns) <= RuleRecord.resolvedcolumns:
+        sys.exit("The resolved columns need -g. Stopping execution")
+    return columns
+
+def getRuleChanges(sink, changes):
+    """Write the rules added, changed or removed since the previous run to the Rule Changes sheet."""
+    sink.addSheet("Rule Changes", ["Change", "Rule Name", "Firewall", "Rule Section", "Rule Type"])
+    for change, firewall, rulesection, ruletype, name in changes:
+        sink.writeRow("Rule Changes", [change, name, firewall, rulesection, ruletype])
+
+def getDiffRules(records):
+    """Return an OrderedDict of the rule records by (firewall, rule section, rule type, name,
+    occurrence), occurrence telling apart rules of a rulebase with the same name."""
+    index = OrderedDict()
+    counts = {}
+    for record in records:
+        key = (record.firewall, record.rulesection, record.ruletype, record.name)
+        counts[key] = counts.get(key, -1) + 1
+        index[key + (counts[key],)] = record
+    return index
+
+def getDiffObjects(objectindex):
+    """Return an OrderedDict of object type to an OrderedDict of its records by (scope, "", "",
+    name, occurrence), keyed like getDiffRules so both are written by writeDiff."""
+    indexes = OrderedDict()
+    for kind, getrecord in [("address", getObjectRecord)] + [(kind, typed[1]) for kind, typed in typedobjects.items()]:
+        index = indexes[kind] = OrderedDict()
+        counts = {}
+        for entry in objectindex.getEntries(kind):
+            key = (getScope(entry), "", "", entry.attrib.get("name"))
+            counts[key] = counts.get(key, -1) + 1
+            index[key + (counts[key],)] = getrecord(entry)
+    return indexes
+
+def writeDiffHeaders(sink):
+    """Write the header rows of the Added, Removed and Modified sheets."""
+    titles = ["Type", "Name", "Scope", "Rule Section", "Rule Type"]
+    sink.addSheet("Added", titles)
+    sink.addSheet("Removed", titles)
+    sink.addSheet("Modified", titles + ["Field", "Old", "New", "Removed Members", "Added Members"], ["Old", "New", "Removed Members", "Added Members"])
+
+def writeDiff(sink, kind, old, new, titles, keycolumns=()):
+    """Write the records of new missing from old to Added, the records of old missing from new to
+    Removed, and one Modified row per field that differs. old and new are indexes of records
+    like getDiffRules, titles the column of each field, keycolumns the fields already in the key.
+    Return the number of rows written."""
+    rows = 0
+    for key in new:
+        if key not in old:
+            sink.writeRow("Added", [kind, key[3], key[0], key[1], key[2]])
+            rows += 1
+    for key in old:
+        if key not in new:
+            sink.writeRow("Removed", [kind, key[3], key[0], key[1], key[2]])
+            rows += 1
+    for key, record in new.items():
+        oldrecord = old.get(key)
+        if oldrecord is None or oldrecord == record: # Most rules do not change, one tuple comparison.
+            continue
+        for title, oldvalue, value in zip(titles, oldrecord, record):
+            if oldvalue == value or title in keycolumns:
+                continue
+            if isinstance(value, tuple):
+                oldmembers, members = set(oldvalue), set(value)
+                removed = tuple(member for member in oldvalue if member not in members)
+                added = tuple(member for member in value if member not in oldmembers)
+            else:
+                oldvalue, value = tuple(v for v in (oldvalue,) if v is not None), tuple(v for v in (value,) if v is not None)
+                removed, added = (), ()
+            sink.writeRow("Modified", [kind, key[3], key[0], key[1], key[2], title, oldvalue, value, removed, added])
+            rows += 1
+    return rows
+
+def writeExport(sink, records, objectindex, resolver, allobjects=True, resolvegroups=False, columns=None):
+    """Write the rule records, and every object or only the ones they use, to the Rules and
+    Objects sheets. Return the number of rows written."""
+    rows = 0
+    for record in records:
+        writeRow(sink, record, resolvegroups, columns=columns)
+        rows += 1
+        if allobjects==False:
+            for member in record.source + record.destination:
+                for objectrecord in findbyobjectname(resolver, member, record.firewall):
+                    writeObjectRow(sink, objectrecord)
+                    rows += 1
+    if allobjects==True:
+        for objectrecord in getObjects(objectindex):
+            writeObjectRow(sink, objectrecord)
+            rows += 1
+    return rows
+
+
+loaded = {} # Config file parsed by this process, with its object index and group resolver.
+
+def loadDocument(configfile):
+    """Parse a config file and build its indexes, keeping the last one for the next task of the same process."""
+    if configfile not in loaded:
+        loaded.clear() # Only one config in memory per process.
+        document = etree.parse(configfile).getroot()
+        objectindex = ObjectIndex(document)
+        loaded[configfile] = (document, objectindex, GroupResolver(objectindex, getHierarchy(document)))
+    return loaded[configfile]
+
+def getDeviceGroups(task):
+    """Return the Device Groups or VSYS of a config file that have rules."""
+    configfile, options = task
+    document = loadDocument(configfile)[0]
+    devicegroups = []
+    for entries, rulesection, rulestype, device in walkRules(document, options["virtual_or_deviceg"]):
+        if device.attrib.get("name") not in devicegroups:
+            devicegroups.append(device.attrib.get("name"))
+    return devicegroups
+
+def getBatchRules(task):
+    """Return the RuleRecords of one file, or of one Device Group or VSYS of a file."""
+    configfile, firewall, options = task
+    document, objectindex, resolver = loadDocument(configfile)
+    return list(getRules(document, options["virtual_or_deviceg"], firewall, options["wanted"], resolver if options["resolvegroups"] else None,
+                         columns=options["columns"]))
+
+def getBatchObjects(configfile):
+    """Return the records of every object of one file, like getObjects."""
+    return list(getObjects(loadDocument(configfile)[1]))
+
+def writeBatchFile(task):
+    """Write the rules of one task and the objects of its file to their own output, like a single run with -c and -f."""
+    configfile, firewall, options = task
+    sink = getSink(options["format"], options["outputname"])
+    writeRowHeaders(sink, options["resolvegroups"], columns=options["columns"])
+    writeObjectHeaders(sink, options["wanted"] is None)
+    for record in getBatchRules(task):
+        writeRow(sink, record, options["resolvegroups"], columns=options["columns"])
+    if options["wanted"] is None:
+        for objectrecord in getBatchObjects(configfile):
+            writeObjectRow(sink, objectrecord)
+    sink.close()
+    return options["outputname"]
+
+def getSheetName(name, used):
+    """Return a unique Excel sheet name (31 characters at most, no []:*?/\\)."""
+    for char in "[]:*?/\\":
+        name = name.replace(char, "_")
+    sheet = name[:31]
+    i = 1
+    while sheet in used:
+        i += 1
+        sheet = name[:31 - len(str(i)) - 1] + "~" + str(i)
+    used.add(sheet)
+    return sheet
+
+def batchExport(configfiles, options, excelname, devicegroups=False, batchoutput="combined", jobs=None):
+    """Export several config files, or every Device Group or VSYS of them, with a pool of processes.
+
+    With combined and sheets output the workers return records and only this process
+    writes, so the rows keep the order of the files and Device Groups."""
+    from concurrent.futures import ProcessPoolExecutor # futures backport on Python 2.
+    executor = ProcessPoolExecutor(max_workers=jobs)
+
+    tasks = []
+    if devicegroups:
+        for configfile, names in zip(configfiles, executor.map(getDeviceGroups, [(configfile, options) for configfile in configfiles])):
+            tasks += [(configfile, name) for name in names if options["firewall"] is None or name == options["firewall"]]
+    else:
+        tasks = [(configfile, options["firewall"]) for configfile in configfiles]
+
+    def getLabel(configfile, firewall):
+        """Firewall column or output name of a task. The file is only added when there are several."""
+        labels = [firewall] if firewall is not None else []
+        if len(configfiles) > 1 or firewall is None:
+            labels.insert(0, os.path.splitext(os.path.basename(configfile))[0])
+        return " ".join(labels)
+
+    if batchoutput == "files":
+        base, extension = os.path.splitext(excelname)
+        filetasks = []
+        for configfile, firewall in tasks:
+            fileoptions = dict(options, outputname=base + "_" + getLabel(configfile, firewall).replace("/", "_") + extension)
+            filetasks.append((configfile, firewall, fileoptions))
+        for outputname in executor.map(writeBatchFile, filetasks):
+            if verbose:
+                print outputname
+        executor.shutdown()
+        return
+
+    sink = getSink(options["format"], excelname)
+    sheets = set(["Objects"])
+    if batchoutput == "combined":
+        writeRowHeaders(sink, options["resolvegroups"], columns=options["columns"])
+        writeObjectHeaders(sink, options["wanted"] is None)
+    ruletasks = [(configfile, firewall, options) for configfile, firewall in tasks]
+    objecttasks = []
+    if options["wanted"] is None:
+        objecttasks = [configfile for configfile in configfiles]
+    objectsfuture = executor.map(getBatchObjects, objecttasks) # Runs while the rules are merged.
+    for (configfile, firewall), records in zip(tasks, executor.map(getBatchRules, ruletasks)):
+        if batchoutput == "sheets":
+            sheet = getSheetName(getLabel(configfile, firewall), sheets)
+            writeRowHeaders(sink, options["resolvegroups"], sheet, options["columns"])
+        else:
+            sheet = "Rules"
+        for record in records:
+            if len(configfiles) > 1:
+                record = record._replace(firewall=getLabel(configfile, record.firewall))
+            writeRow(sink, record, options["resolvegroups"], sheet, options["columns"])
+    if batchoutput == "sheets":
+        writeObjectHeaders(sink, options["wanted"] is None) # After the rule sheets so they come first in the workbook.
+    for configfile, objectrecords in zip(objecttasks, objectsfuture):
+        for objectrecord in objectrecords:
+            if len(configfiles) > 1: # The scope is prefixed by the file name like the Firewall column of the rules.
+                scope = "objectscope" if isinstance(objectrecord, ObjectRecord) else "scope"
+                objectrecord = objectrecord._replace(**{scope: getLabel(configfile, getattr(objectrecord, scope))})
+            writeObjectRow(sink, objectrecord)
+    sink.close()
+    executor.shutdown()
+
+
+class LoadedConfig(object):
+    """A config file parsed once with its indexes, kept in memory by the serve mode."""
+
+    def __init__(self, configfile, virtual_or_deviceg):
+        self.configfile = configfile
+        self.virtual_or_deviceg = virtual_or_deviceg
+        self.mtime = os.path.getmtime(configfile)
+        self.document = etree.parse(configfile).getroot()
+        self.objectindex = ObjectIndex(self.document)
+        self.resolver = GroupResolver(self.objectindex, getHierarchy(self.document))
+        self.usageindex = UsageIndex(self.document, self.objectindex)
+        self.rules = list(walkRules(self.document, virtual_or_deviceg)) # Walked once, queries only pick from it.
+        self.positions = dict((rule[0], i) for i, rule in enumerate(self.rules))
+        self.names = {}
+        for i, rule in enumerate(self.rules):
+            self.names.setdefault(rule[0].attrib.get("name"), []).append(i)
+
+    def getRules(self, rulenames=None, objectnames=None, firewall=None):
+        """Return the (entries, rulesection, rulestype, device) of the rules with one of the
+        names, or that use one of the objects, or every rule, in document order."""
+        if rulenames is not None:
+            positions = sorted(set(i for name in rulenames for i in self.names.get(name, [])))
+        elif objectnames is not None:
+            positions = sorted(self.positions[entries] for entries in self.usageindex.findRules(objectnames) if entries in self.positions)
+        else:
+            positions = range(len(self.rules))
+        return [self.rules[i] for i in positions if firewall is None or self.rules[i][3].attrib.get("name") == firewall]
+
+    def query(self, rules, allobjects=True, resolvegroups=False):
+        """Return the Rules and Objects sheets of an export of the rules as lists of rows."""
+        sink = MemorySink()
+        writeRowHeaders(sink, resolvegroups)
+        writeObjectHeaders(sink, allobjects)
+        writeExport(sink, getRecords(rules, self.resolver if resolvegroups else None), self.objectindex, self.resolver, allobjects, resolvegroups)
+        return sink.sheets
+
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer the JSON queries of the serve mode:
+
+    /configs                     the config files loaded
+    /rules?name=RULE             the rules with that name, like -r
+    /objects?name=OBJECT         the rules that use the objects, like -o (name can be repeated)
+    /export                      every rule and object
+
+    firewall=NAME, config=FILE (one of the files loaded, the first one by default) and
+    resolvegroups=1 can be added to the queries of rules."""
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        if url.path == "/configs":
+            return self.reply(200, [OrderedDict([("config", config.configfile), ("mtime", config.mtime)]) for config in self.server.configs.values()])
+        if url.path not in ("/rules", "/objects", "/export"):
+            return self.reply(404, {"error": "Unknown query %s" % url.path})
+        config = self.getConfig(params.get("config", [None])[0])
+        if config is None:
+            return self.reply(404, {"error": "Config file not loaded"})
+        names = params.get("name", [])
+        if url.path != "/export" and not names:
+            return self.reply(400, {"error": "name is needed"})
+
+        started = time.time()
+        firewall = params.get("firewall", [None])[0]
+        if url.path == "/rules":
+            rules = config.getRules(rulenames=names, firewall=firewall)
+        elif url.path == "/objects":
+            rules = config.getRules(objectnames=names, firewall=firewall)
+        else:
+            rules = config.getRules(firewall=firewall)
+        sheets = config.query(rules, url.path == "/export", params.get("resolvegroups", ["0"])[0] == "1")
+        self.reply(200, OrderedDict([("config", config.configfile), ("seconds", round(time.time() - started, 6))] + sheets.items()))
+
+    def getConfig(self, name):
+        """Return the loaded config with that path or file name, or the first one."""
+        configs = self.server.configs # Replaced as a whole by the watcher, read once.
+        if name is None:
+            return configs.values()[0]
+        for config in configs.values():
+            if name in (config.configfile, os.path.basename(config.configfile), os.path.splitext(os.path.basename(config.configfile))[0]):
+                return config
+        return None
+
+    def reply(self, status, content):
+        body = json.dumps(content)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def watchConfigs(server, interval):
+    """Reload the config files that change on disk, every interval seconds. A file that
+    cannot be parsed (still being copied...) keeps the previous version until the next check."""
+    failed = {} # Modification time of the files that could not be parsed, not tried again until they change.
+    while True:
+        time.sleep(interval)
+        configs = OrderedDict(server.configs)
+        for configfile, config in configs.items():
+            mtime = None
+            try:
+                mtime = os.path.getmtime(configfile)
+                if mtime != config.mtime and mtime != failed.get(configfile):
+                    configs[configfile] = LoadedConfig(configfile, config.virtual_or_deviceg)
+                    print "Reloaded", configfile
+            except (OSError, IOError, etree.XMLSyntaxError) as error:
+                failed[configfile] = mtime
+                print >> sys.stderr, "Could not reload %s: %s" % (configfile, error)
+        server.configs = configs # Queries running keep the configs they started with.
+
+def serve(configfiles, virtual_or_deviceg, address, interval=2):
+    """Load the config files once and answer queries over HTTP until interrupted."""
+    host, port = "127.0.0.1", address
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+    server = BaseHTTPServer.HTTPServer((host, int(port)), QueryHandler)
+    server.configs = OrderedDict((configfile, LoadedConfig(configfile, virtual_or_deviceg)) for configfile in configfiles)
+    watcher = threading.Thread(target=watchConfigs, args=(server, interval))
+    watcher.daemon = True
+    watcher.start()
+    print "Serving %s on http://%s:%s/" % (", ".join(configfiles), host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
 
 
 if __name__ == '__main__':
 
     #Get command line arguments
     commandlineparser()
+    verbose = args.verbose
+    stats = Stats(args.profile)
 
-    row = 0 # Used to track which excel row we are on while parsing XML.
-    objectrow=0
-    rulesfound=[]
+    wanted = None # Every rule unless looking for a rule or an object.
     allobjects = True
 
-    if args.configfile == None:
-        document = etree.parse('policy-best-practices.xml').getroot() # Parse the page the firewall returned as a string into the document object.
+    configfiles = []
+    for pattern in args.configfile or ['policy-best-practices.xml']:
+        configfiles += sorted(glob.glob(pattern)) or [pattern] # Let etree report a file that does not exist.
+    configfile = configfiles[0]
+
+    if args.virtualsystem== False:
+        virtual_or_deviceg='device-group'
     else:
-        document = etree.parse(args.configfile).getroot()
+        virtual_or_deviceg='vsys'
 
-    if args.firewall == None:
-        firewall_name=']'
+    if args.excelname == None:
+        excelname = 'Firewall_Policies.' + args.format
     else:
-        firewall_name="='"+args.firewall+"']"
-        print firewall_name
+        excelname = args.excelname
+
+    columns = None # Every column of the rules.
+    decoded = None
+    if args.columns != None:
+        columns = getColumns(args.columns, args.resolvegroups)
+        decoded = set(columns)
+
+    addresses = (args.ip or []) + (args.cidr or [])
+    if args.ipfile != None:
+        with open(args.ipfile) as ipfile:
+            addresses += [line.strip() for line in ipfile if line.strip()]
+
+    if args.serve != None:
+        serve(configfiles, virtual_or_deviceg, args.serve)
+        sys.exit()
+
+    if args.diff != None:
+        if len(configfiles) > 1 or args.alldevicegroups or args.stream or args.objectname != None or args.rulename != None or args.unused or args.incremental != None or args.shadowed or args.effective or addresses or args.snapshot != None:
+            sys.exit("A diff compares two config files and only takes -f, -g and the output options. Stopping execution")
+        if decoded is not None:
+            decoded.update(RuleRecord._fields.index(field) for field in ("name", "rulesection", "ruletype", "firewall")) # The key of a rule.
+        indexes = []
+        for diffconfig in (args.diff, configfile):
+            stats.start("parse")
+            document = etree.parse(diffconfig).getroot()
+            stats.stop("parse")
+            stats.start("index")
+            objectindex = ObjectIndex(document)
+            resolver = GroupResolver(objectindex, getHierarchy(document)) if args.resolvegroups else None
+            stats.stop("index")
+            stats.start("extract")
+            indexes.append((getDiffRules(getRules(document, virtual_or_deviceg, args.firewall, None, resolver, columns=decoded)), getDiffObjects(objectindex)))
+            stats.stop("extract", len(indexes[-1][0]) + sum(len(index) for index in indexes[-1][1].values()))
+            del document, objectindex, resolver # Only the records are compared.
+        (oldrules, oldobjects), (rules, objects) = indexes
+        stats.start("write")
+        sink = getSink(args.format, excelname)
+        writeDiffHeaders(sink)
+        rows = writeDiff(sink, "Rule", oldrules, rules, RuleRecord.titles, ("Rule Name", "Rule Section", "Rule Type", "Firewall"))
+        for kind, recordtype in [("address", ObjectRecord)] + [(kind, typed[0]) for kind, typed in typedobjects.items()]:
+            rows += writeDiff(sink, kind.replace("-", " ").title(), oldobjects[kind], objects[kind], recordtype.titles, (recordtype.titles[0], "Shared", "Scope"))
+        sink.close()
+        stats.stop("write", rows)
+        if args.stats != None or args.profile:
+            stats.write(args.stats or os.path.splitext(excelname)[0] + "_stats.json")
+        sys.exit()
+
+    if len(configfiles) > 1 or args.alldevicegroups:
+        if args.stream or args.objectname != None or args.unused or args.incremental != None or args.shadowed or args.effective or addresses or args.snapshot != None:
+            sys.exit("It is not possible to stream, find by object or address, find unused objects, use a cache or a snapshot or find shadowed rules or the effective policy with several files or -a. Stopping execution")
+        options = {"virtual_or_deviceg": virtual_or_deviceg, "firewall": args.firewall, "wanted": set([args.rulename]) if args.rulename != None else None,
+                   "resolvegroups": args.resolvegroups, "format": args.format, "columns": columns}
+        stats.start("batch")
+        batchExport(configfiles, options, excelname, args.alldevicegroups, args.batchoutput, args.jobs)
+        stats.stop("batch", len(configfiles))
+        if args.stats != None or args.profile:
+            stats.write(args.stats or os.path.splitext(excelname)[0] + "_stats.json")
+        sys.exit()
+
+    if args.stream and (args.objectname != None or addresses):
+        sys.exit("It is not possible to find by object or address while streaming the config file. Stopping execution")
+    if args.stream and args.unused:
+        sys.exit("It is not possible to find unused objects while streaming the config file. Stopping execution")
+    if args.stream and args.resolvegroups:
+        sys.exit("It is not possible to resolve groups while streaming the config file. Stopping execution")
+    if args.stream and args.shadowed:
+        sys.exit("It is not possible to find shadowed rules while streaming the config file. Stopping execution")
+    if args.stream and args.effective:
+        sys.exit("It is not possible to build the effective policy while streaming the config file. Stopping execution")
+    if args.incremental != None and (args.stream or args.objectname != None or args.rulename != None or addresses):
+        sys.exit("It is not possible to use a cache while streaming or finding by rule, object or address. Stopping execution")
+    if args.snapshot != None and (args.stream or args.unused or args.shadowed or args.effective or addresses or args.incremental != None):
+        sys.exit("Snapshots only answer exports, -r and -o. Stopping execution")
+    if addresses and (args.objectname != None or args.rulename != None):
+        sys.exit("It is not possible to find by address and rule or object at the same time. Stopping execution")
+
+    snapshot = None
+    if args.snapshot != None:
+        stats.start("load")
+        snapshotfile = args.snapshot or os.path.splitext(configfile)[0] + ".snapshot"
+        if os.path.exists(snapshotfile):
+            snapshot = Snapshot(snapshotfile)
+            if not snapshot.isValid(configfile, virtual_or_deviceg):
+                snapshot.close()
+                snapshot = None
+        if snapshot is None:
+            document = etree.parse(configfile).getroot()
+            objectindex = ObjectIndex(document)
+            writeSnapshot(snapshotfile, configfile, virtual_or_deviceg, document, objectindex, GroupResolver(objectindex, getHierarchy(document)))
+            del document, objectindex
+            snapshot = Snapshot(snapshotfile)
+        stats.stop("load")
+
+    if args.stream == False and snapshot is None:
+        stats.start("parse")
+        document = etree.parse(configfile).getroot() # Parse the page the firewall returned as a string into the document object.
+        stats.stop("parse")
+        stats.start("index")
+        objectindex = ObjectIndex(document)
+        resolver = GroupResolver(objectindex, getHierarchy(document))
+        if args.objectname != None or args.unused:
+            usageindex = UsageIndex(document, objectindex)
+        stats.stop("index")
+
+    cache = None
+    if args.incremental != None:
+        cache = RuleCache(args.incremental or os.path.splitext(excelname)[0] + ".sqlite")
+
+    if args.firewall != None and verbose:
+        print args.firewall
 
     # if args.rulebase== None:
     #     rule_type='pre-rulebase'
@@ -336,185 +2069,129 @@ if __name__ == '__main__':
     #     security_or_nat=args.nat
 
 
-    if args.virtualsystem== False:
-        virtual_or_deviceg='device-group'
-    else:
-        virtual_or_deviceg='vsys'
-
+    if args.objectname != None and args.rulename == None and snapshot is not None:
+        rulesfound = set()
+        for findrule in snapshot.findRules(args.objectname):
+            rulesfound.add(findrule)
+            if verbose:
+                print snapshot.getName(findrule)
+        wanted = rulesfound.__contains__
+        allobjects=False
+    elif args.objectname != None and args.rulename == None:
+        rulesfound = set()
+        for findrule in usageindex.findRules(args.objectname):
+            rulesfound.add(findrule)
+            if verbose:
+                print findrule.attrib.get("name")
+        wanted = rulesfound.__contains__ # The rules themselves, not every rule with the same name.
+        allobjects=False
 
-    if args.objectname== None and args.rulename == None:
-        rulename="]"
-        rulesfound.append(rulename)
-    if args.objectname != None and args.rulename == None:
-        hostname=".//*[member='"+args.objectname+"']/../../"
-        #print hostname
-        for findrule in document.findall(hostname):#(".//rules/entry/source/[member%s" %hostname):
-            rulename = "='"+findrule.attrib.get("name")+"']"
-            if findrule.find(".//*[member='"+args.objectname+"']")!= None and findrule.find("destination")!=None:
-                rulesfound.append(rulename)
-            print rulename
+    if addresses:
+        stats.start("index")
+        addressindex = AddressIndex(walkRules(document, virtual_or_deviceg, args.firewall), objectindex, resolver)
+        lookups = []
+        rulesfound = set()
+        for address in addresses:
+            found = addressindex.getRules(address)
+            if found is None:
+                sys.exit("%s is not an IPv4 address, network or range. Stopping execution" % address)
+            lookups.append((address,) + found)
+            rulesfound.update(found[1])
+        wanted = rulesfound.__contains__
         allobjects=False
-            # if findrule.find(".//*[member='"+args.objectname+"']")!= None and findrule.getparent().tag=="address-group":
-            #     group= findrule.attrib.get("name")
-            #     rulegroup = "='"+findrule.attrib.get("name")+"']"
-            #     print group
-            #     groupname=".//*[member='"+findrule.attrib.get("name")+"']/../../"
-            #     for findrule2 in document.findall(groupname):#(".//rules/entry/source/[member%s" %hostname):
-            #         rulename2 = "='"+findrule2.attrib.get("name")+"']"
-            #         if findrule2.find(".//*[member='"+findrule.attrib.get("name")+"']")!= None and findrule2.find("destination")!=None:
-            #             print findrule2.getparent().tag
-            #             test = findrule2.find(".//*[member='"+group+"']")
-            #             test2 = findrule2.text
-            #             print rulename2
-            #             print test2
-                        #rulesfound.append(rulename2)
-                        #print rulename2
-            
-    print rulesfound
+        stats.stop("index")
+
     if args.objectname == None and args.rulename!= None:
-        rulename= "='"+args.rulename+"']"
-        rulesfound.append(rulename)
+        wanted = set([args.rulename])
         allobjects=False
     if args.objectname != None and args.rulename!= None:
         sys.exit("It is not possible to find by object and rule at the same time. Stopping execution")
 
-    if args.excelname == None:
-        workbook = xlsxwriter.Workbook('Firewall_Policies.xlsx') # Create Excel spreadsheet.
+    if decoded is not None and allobjects==False:
+        decoded.update(RuleRecord._fields.index(field) for field in ("source", "destination", "firewall")) # To find the objects of the rules.
+
+    sink = getSink(args.format, excelname)
+
+    writeRowHeaders(sink, args.resolvegroups, columns=columns) # Create friendly row headers in the spreadsheet.
+    writeObjectHeaders(sink, allobjects)
+
+    stats.start("write")
+    rows = 0
+    if args.stream:
+        objectsfound = [] # Objects used by the rules found, written once the whole file is read.
+        for kind, entry in stats.measure("parse", streamconfig(configfile, virtual_or_deviceg, args.firewall)):
+            if kind == "rule":
+                if isWanted(entry, wanted):
+                    rulestype = entry.getparent().getparent()
+                    rulesection = rulestype.getparent()
+                    record = getRule(entry, rulesection, rulestype, rulesection.getparent(), columns=decoded)
+                    writeRow(sink, record, columns=columns)
+                    rows += 1
+                    if allobjects==False:
+                        objectsfound.extend((member, record.firewall) for member in record.source + record.destination)
+            elif kind == "address" and allobjects==True:
+                writeObjectRow(sink, getObjectRecord(entry))
+                rows += 1
+            elif kind in typedobjects and allobjects==True:
+                writeObjectRow(sink, typedobjects[kind][1](entry))
+                rows += 1
+        if objectsfound:
+            streamed = StreamedObjects() # Groups are expanded like the full tree does, so they are all needed.
+            for kind, entry in stats.measure("parse", streamconfig(configfile, virtual_or_deviceg, args.firewall)):
+                if kind == "parent-dg":
+                    if entry.text is not None:
+                        streamed.parents[entry.getparent().attrib.get("name")] = entry.text
+                else:
+                    streamed.add(kind, entry)
+            streamresolver = GroupResolver(streamed, streamed.parents)
+            for objectfind, firewall in objectsfound:
+                for kind, where, foundobject in streamresolver.getObjects("address", objectfind, firewall):
+                    writeObjectRow(sink, foundobject)
+                    rows += 1
+    elif snapshot is not None:
+        for record in stats.measure("extract", snapshot.getRules(args.firewall, wanted)):
+            writeRow(sink, record, args.resolvegroups, columns=columns)
+            rows += 1
+            if allobjects==False:
+                for member in record.source + record.destination:
+                    for objectrecord in snapshot.findObjects(member, record.firewall):
+                        if verbose:
+                            print objectrecord.objectname
+                        writeObjectRow(sink, objectrecord)
+                        rows += 1
+        if allobjects==True:
+            for objectrecord in snapshot.getObjects():
+                writeObjectRow(sink, objectrecord)
+                rows += 1
+        snapshot.close()
     else:
-        workbook = xlsxwriter.Workbook(args.excelname) # Create Excel spreadsheet.
-
-    worksheet = workbook.add_worksheet("Rules") # Create new worksheet within the spreadsheet.
-    worksheet_objects = workbook.add_worksheet("Objects")
-
-    bold = workbook.add_format({'bold': True}) # Cell formatting for row header
-
-    dataformat = workbook.add_format() # Cell Formatting for data.
-    dataformat.set_align('top')
-
-    excelobj = Spreadsheet()
-    excelobjects =Spreadsheet()
-    excelobj.writeRowHeaders() # Create friendly row headers in the spreadsheet.
-    excelobj.writeObjectHeaders()
-
-    for numberrules in rulesfound:
-        print numberrules
-        for config in document: # Start after root (result)
-            for devices in config.iter(virtual_or_deviceg): #depending of xml file value here can be "device-group" or "vsys1"
-                for device in devices.findall(".//*[@name%s" %firewall_name):
-                    for rulesection in device:#.iter("%s" %rule_type):
-                        for rulestype in rulesection:#.iter("%s" %security_or_nat): # Start after result (rules)
-                            for rules in rulestype.findall("rules"):
-                                for entries in rules.findall(".//*[@name%s" %numberrules): # Start iterating after rules (entries)
-                                    row += 1
-                                    excelobj.setName(name=entries.attrib.get("name")) # Populate the rule description. Used attrib.get since name is a value within the tag.
-
-                                    for fromzone in entries.findall("from"): # From zone block
-                                        for members in fromzone.findall("member"): # From zone block - members block
-                                            excelobj.setFromMember(members.text)
-
-                                    for tozone in entries.findall("to"): # To zone block
-                                        for members in tozone.findall("member"): # To zone block - members block
-                                            excelobj.setToMember(members.text)
-
-                                    for source in entries.findall("source"): # From source block
-                                        for members in source.findall("member"): # From source block - members block
-                                            excelobj.setSource(members.text)
-                                            if allobjects==False:
-                                                objectrow = findbyobjectname(document, members.text, objectrow)
-
-                                    for source_trans in entries.findall("source-translation"): # From source block
-                                        for members in source_trans: # From source block - members block
-                                            if members.text is not None:
-                                                excelobj.setSourceTranslation(members.text)
-                                                # print "is not empty"
-                                                # print members.text
-                                            for submembers in members:
-                                                if submembers.text is not None:
-                                                    excelobj.setSourceTranslation(submembers.text)
-                                                    # print "is not empty"
-                                                    # print submembers.text
-                                                for last in submembers:
-                                                    if last.text is not None:
-                                                        excelobj.setSourceTranslation(last.text)
-                                                        # print "is not empty"
-                                                        # print last.text
-
-                                    for destination in entries.findall("destination"): # application block
-                                        for members in destination.findall("member"): # application block - members block
-                                            excelobj.setDestination(members.text)
-                                            if allobjects== False:
-                                                objectrow = findbyobjectname(document, members.text, objectrow)
-
-
-                                    for destination_trans in entries.findall("destination-translation"): # From source block
-                                        for members in destination_trans: # From source block - members block
-                                            if members.text is not None:
-                                                excelobj.setDestinationTranslation(members.text)
-                                                # print "is not empty"
-                                                # print members.text
-                                            for submembers in members:
-                                                if submembers.text is not None:
-                                                    excelobj.setDestinationTranslation(submembers.text)
-                                                    # print "is not empty"
-                                                    # print submembers.text
-                                                for last in submembers:
-                                                    if last.text is not None:
-                                                        excelobj.setDestinationTranslation(last.text)
-                                                        # print "is not empty"
-                                                        # print last.text
-
-                                    for application in entries.findall("application"): # application block
-                                        for members in application.findall("member"): # application block - members block
-                                            excelobj.setApplication(members.text)
-
-                                    for service in entries.findall("service"): # application block
-                                        for members in service.findall("member"): # application block - members block
-                                            excelobj.setServices(members.text)
-
-                                    for hipprofiles in entries.findall("hip-profiles"): # application block
-                                        for members in hipprofiles.findall("member"): # application block - members block
-                                            excelobj.setHipprofiles(members.text)
-
-                                    for action in entries.findall("action"):
-                                        excelobj.setAction(action.text)
-
-                                    for description in entries.findall("description"):
-                                        excelobj.setDescription(description.text)
-
-                                    for logstart in entries.findall("log-start"):
-                                        excelobj.setLogstart(logstart.text)
-
-                                    for logend in entries.findall("log-end"):
-                                        excelobj.setLogend(logend.text)
-
-                                    for tag in entries.findall("tag"): # application block
-                                        for members in tag.findall("member"): # application block - members block
-                                            excelobj.setTag(members.text)
-
-                                    for profilesetting in entries.findall("profile-settings"): # application block
-                                        for members in tag.findall("member"): # application block - members block
-                                            excelobj.setTag(members.text)
-
-                                    for disabled in entries.findall("disabled"):
-                                        excelobj.setDisabled(disabled.text)
-
-                                    for expiration in entries.findall("schedule"):
-                                        excelobj.setExpiration(expiration.text)
-
-                                    #rulesection
-                                    excelobj.setRuletype(rulestype.tag)
-                                    excelobj.setRulesection(rulesection.tag)
-                                    excelobj.setFirewall(device.attrib.get("name")) 
-                                    #print(device.attrib.get("name"))
-                                    
-                                    #firewall
-
-                                    excelobj.writeRow(row) # Write each row to the spreadsheet.
-                                    excelobj.newRow() # Clear old values and start new row.
-    if allobjects==True:
-        getObjects(document)
-    workbook.close() # Close the spreadsheet since we are done with it now.
-
+        records = getRules(document, virtual_or_deviceg, args.firewall, wanted, resolver if args.resolvegroups else None, cache, decoded)
+        rows = writeExport(sink, stats.measure("extract", records), objectindex, resolver, allobjects, args.resolvegroups, columns)
+        stats.start("analyze")
+        if args.unused:
+            getUnusedObjects(sink, objectindex, usageindex)
+        if addresses:
+            walked = set(entries for entries, rulesection, rulestype, device in walkRules(document, virtual_or_deviceg, args.firewall, wanted))
+            getAddressLookup(sink, lookups, walked)
+        if args.shadowed:
+            getShadowedRules(sink, document, virtual_or_deviceg, args.firewall, objectindex, resolver)
+        if args.effective:
+            getEffectivePolicy(sink, document, virtual_or_deviceg, args.firewall, resolver if args.resolvegroups else None, columns)
+        if cache is not None:
+            rulebases = set() # Only needed to tell the other firewalls from the removed ones.
+            if args.firewall != None:
+                rulebases = set((device.attrib.get("name"), rulesection.tag, rulestype.tag)
+                                for rules, rulesection, rulestype, device in getRulebases(document, virtual_or_deviceg))
+            changes = cache.close(rulebases, args.firewall)
+            if verbose:
+                for change in ("Added", "Changed", "Removed"):
+                    print "%s rules: %d" % (change, len([1 for found in changes if found[0] == change]))
+            if not cache.created: # Everything is new on the first run.
+                getRuleChanges(sink, changes)
+        stats.stop("analyze")
+    sink.close()
+    stats.stop("write", rows)
+
+    if args.stats != None or args.profile:
+        stats.write(args.stats or os.path.splitext(excelname)[0] + "_stats.json")
 
-#TODO:
-#Make it work with object groups